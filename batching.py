@@ -0,0 +1,81 @@
+import os
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class UploadBatch:
+    """Uploads collected under one key while its window is open"""
+
+    def __init__(self, key, started):
+        self.key = key
+        self.items = []
+        self.started = started
+        self.last_added = started
+        self.full = asyncio.Event()
+        self.task = None
+
+
+class UploadBatcher:
+    """Coalesce bursts of uploads into batches before they are stored.
+
+    Items are grouped by a caller-supplied key (a media group, or a user when
+    files arrive one by one). A batch is handed to ``on_flush`` once no new item
+    arrived for ``window`` seconds, once it is ``max_delay`` seconds old, or as
+    soon as it holds ``max_size`` items.
+    """
+
+    def __init__(self, on_flush, window=None, max_delay=None, max_size=None):
+        self.on_flush = on_flush
+        self.window = window if window is not None else float(os.environ.get("UPLOAD_BATCH_WINDOW", 1.0))
+        self.max_delay = max_delay if max_delay is not None else float(os.environ.get("UPLOAD_BATCH_MAX_DELAY", 5.0))
+        self.max_size = max_size if max_size is not None else int(os.environ.get("UPLOAD_BATCH_MAX_SIZE", 50))
+        self._batches = {}
+
+    def add(self, key, item):
+        """Add an item to the open batch for ``key``, opening one if needed"""
+        loop = asyncio.get_running_loop()
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = UploadBatch(key, loop.time())
+            self._batches[key] = batch
+            batch.task = loop.create_task(self._run(batch))
+
+        batch.items.append(item)
+        batch.last_added = loop.time()
+        if len(batch.items) >= self.max_size:
+            batch.full.set()
+
+    @property
+    def pending(self):
+        """Number of items waiting in open batches"""
+        return sum(len(batch.items) for batch in self._batches.values())
+
+    async def drain(self):
+        """Flush every open batch now, e.g. before shutting down"""
+        for batch in list(self._batches.values()):
+            batch.full.set()
+        tasks = [batch.task for batch in self._batches.values() if batch.task]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, batch):
+        loop = asyncio.get_running_loop()
+        while not batch.full.is_set():
+            deadline = min(batch.last_added + self.window, batch.started + self.max_delay)
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(batch.full.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+
+        # Close the batch before flushing so later items open a fresh one
+        if self._batches.get(batch.key) is batch:
+            del self._batches[batch.key]
+        try:
+            await self.on_flush(batch.items)
+        except Exception as e:
+            logger.error(f"Error flushing upload batch of {len(batch.items)} items: {e}")
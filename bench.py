@@ -0,0 +1,595 @@
+"""Replay synthetic traffic through the bot against a fake Telegram Bot API.
+
+Starts a local stand-in for the Bot API, runs the bot against it in a
+subprocess and drives it with virtual users. Each user first uploads a set of
+files, then keeps sending a weighted mix of:
+
+- upload:   a document message
+- myfiles:  the /myfiles command
+- page:     a "Show More Files" / "Previous" button from the last file list
+- download: a file button from the last file list
+
+Every user waits for the bot's reply before sending the next update, so the
+numbers describe the bot rather than a flooded queue. Both update paths can be
+measured: polling (``python main.py``) and webhook (gunicorn, with the fake
+API posting updates to /webhook/<token>). For each path the report shows p50
+and p99 latency per action, updates per second and database queries per
+update, read from the bot's /metrics.
+
+Latency runs from handing the update to the bot until its reply reaches the
+fake API. Uploads include the upload batching window (UPLOAD_BATCH_WINDOW).
+Outbound rate limits are lifted unless --telegram-limits is given, so the
+throughput is the bot's own rather than Telegram's 30 messages per second.
+
+Usage: python bench.py [--mode polling|webhook|both] [--users 20] [--updates 1000]
+                       [--mix upload=2,myfiles=2,page=3,download=3] [--files 30]
+                       [--database postgresql://...] [--json results.json]
+
+Without --database each run uses a fresh SQLite file. A Postgres database
+keeps the rows from earlier runs, so point it at a scratch database.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import signal
+import socket
+import argparse
+import tempfile
+import itertools
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BOT_TOKEN = "123456:bench-token"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+# The Bot API call that completes each action, i.e. the reply the user sees
+ACTION_REPLIES = {
+    "upload": {"sendMessage"},
+    "myfiles": {"sendMessage"},
+    "page": {"sendMessage", "editMessageText", "editMessageReplyMarkup"},
+    "download": {"editMessageText"},
+}
+DEFAULT_MIX = "upload=2,myfiles=2,page=3,download=3"
+
+# Uploads sent in one burst while seeding; stays below UPLOAD_BATCH_MAX_SIZE
+SEED_CHUNK = 20
+
+# Webhook deliveries answered 503 (a worker still starting) are retried every 0.1s, this many times
+WEBHOOK_DELIVERY_ATTEMPTS = 100
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class FakeBotAPI:
+    """Minimal in-process Bot API: answers the methods the bot calls and hands out updates.
+
+    Updates are served from getUpdates, or posted to the webhook URL once the
+    bot has called setWebhook. Every call addressed to a chat is recorded so
+    virtual users can wait for the bot's reply.
+    """
+
+    def __init__(self, webhook_workers=40):
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.allowed_updates = None
+        self.polled = threading.Event()
+        self.calls = defaultdict(int)
+        self.delivery_errors = 0
+        self._updates = deque()
+        self._chat_calls = defaultdict(list)
+        self._condition = threading.Condition()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1000)
+        self._webhook_pool = ThreadPoolExecutor(max_workers=webhook_workers)
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                api._handle_http(self)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-bot-api", daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self._webhook_pool.shutdown(wait=False, cancel_futures=True)
+
+    # Updates
+
+    def deliver(self, update):
+        """Hand an update to the bot the way Telegram would"""
+        update["update_id"] = next(self._update_ids)
+        if self.webhook_url:
+            self._webhook_pool.submit(self._post_update, self.webhook_url, self.webhook_secret, update)
+        else:
+            with self._condition:
+                self._updates.append(update)
+                self._condition.notify_all()
+
+    def _post_update(self, url, secret, update):
+        headers = {"Content-Type": "application/json"}
+        if secret:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+        request = urllib.request.Request(url, data=json.dumps(update).encode(), headers=headers)
+        for attempt in range(WEBHOOK_DELIVERY_ATTEMPTS):
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    response.read()
+                return
+            except urllib.error.HTTPError as e:
+                # Like Telegram, redeliver while a worker that is still starting answers 503
+                if e.code != 503:
+                    break
+                time.sleep(0.1)
+            except (urllib.error.URLError, OSError):
+                break
+        with self._condition:
+            self.delivery_errors += 1
+
+    def _get_updates(self, params):
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        limit = int(params.get("limit") or 100)
+        self.polled.set()
+        with self._condition:
+            while not self._updates and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            return [self._updates.popleft() for _ in range(min(limit, len(self._updates)))]
+
+    # Replies
+
+    def mark(self, chat_id):
+        """Position in the chat's call log; pass it to wait_for to skip earlier calls"""
+        with self._condition:
+            return len(self._chat_calls[chat_id])
+
+    def wait_for(self, chat_id, methods, start, timeout):
+        """Wait for a call to one of ``methods`` in the chat after ``start``; returns (call, next start)"""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                calls = self._chat_calls[chat_id]
+                for index in range(start, len(calls)):
+                    if calls[index]["method"] in methods:
+                        return calls[index], index + 1
+                start = len(calls)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None, start
+                self._condition.wait(remaining)
+
+    def _message(self, chat_id, message_id=None, **fields):
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            **fields,
+        }
+
+    def _call(self, method, params):
+        chat_id = params.get("chat_id")
+        if method == "getUpdates":
+            self.allowed_updates = params.get("allowed_updates")
+            return self._get_updates(params)
+        if method == "getMe":
+            return BOT_USER
+        if method == "getWebhookInfo":
+            return {"url": self.webhook_url or "", "has_custom_certificate": False, "pending_update_count": 0}
+        if method == "setWebhook":
+            self.webhook_url = params["url"]
+            self.webhook_secret = params.get("secret_token")
+            self.allowed_updates = params.get("allowed_updates")
+            return True
+        if method == "deleteWebhook":
+            self.webhook_url = None
+            return True
+        if method == "sendMediaGroup":
+            return [self._message(chat_id) for _ in params.get("media") or ()]
+        if method.startswith("send") or method.startswith("copy"):
+            return self._message(chat_id, text=params.get("text") or "")
+        if method.startswith("edit") and chat_id is not None:
+            return self._message(chat_id, params.get("message_id"), text=params.get("text") or "")
+        return True
+
+    def _handle_http(self, handler):
+        _, _, method = handler.path.rpartition("/")
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = handler.rfile.read(length).decode() if length else ""
+        params = {}
+        if handler.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            for name, values in parse_qs(body).items():
+                try:
+                    params[name] = json.loads(values[0])
+                except ValueError:
+                    params[name] = values[0]
+
+        result = self._call(method, params)
+        with self._condition:
+            self.calls[method] += 1
+            if params.get("chat_id") is not None:
+                self._chat_calls[int(params["chat_id"])].append({
+                    "method": method,
+                    "params": params,
+                    "message_id": result.get("message_id") if isinstance(result, dict) else None,
+                })
+                self._condition.notify_all()
+
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        try:
+            handler.send_response(200)
+            handler.send_header("Content-Type", "application/json")
+            handler.send_header("Content-Length", str(len(payload)))
+            handler.end_headers()
+            handler.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # The bot went away mid long poll, e.g. while stopping
+            pass
+
+
+def button_callbacks(params):
+    """callback_data of every button in a reply's inline keyboard"""
+    markup = params.get("reply_markup")
+    if isinstance(markup, str):
+        markup = json.loads(markup)
+    rows = (markup or {}).get("inline_keyboard") or []
+    return [button["callback_data"] for row in rows for button in row if "callback_data" in button]
+
+
+class VirtualUser:
+    """One private chat with the bot, sending an update and waiting for its reply in a loop"""
+
+    def __init__(self, api, user_id, run_id, timeout):
+        self.api = api
+        self.user_id = user_id
+        self.run_id = run_id
+        self.timeout = timeout
+        self.uploads = 0
+        self.screen = None  # (message_id, callbacks) of the last file list
+        self.latencies = defaultdict(list)
+        self.timeouts = defaultdict(int)
+
+    def _user(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": "Bench", "username": f"bench{self.user_id}"}
+
+    def _chat(self):
+        return {"id": self.user_id, "type": "private", "first_name": "Bench"}
+
+    def _message_update(self, **fields):
+        return {"message": {
+            "message_id": next(self.api._message_ids),
+            "date": int(time.time()),
+            "chat": self._chat(),
+            "from": self._user(),
+            **fields,
+        }}
+
+    def command_update(self, command):
+        return self._message_update(
+            text=command, entities=[{"type": "bot_command", "offset": 0, "length": len(command)}]
+        )
+
+    def upload_update(self):
+        self.uploads += 1
+        name = f"bench_{self.uploads:05d}.pdf"
+        return self._message_update(document={
+            "file_id": f"bench-{self.run_id}-{self.user_id}-{self.uploads}",
+            "file_unique_id": f"{self.run_id}-{self.user_id}-{self.uploads}",
+            "file_name": name,
+            "mime_type": "application/pdf",
+            "file_size": 1024 * self.uploads,
+        })
+
+    def callback_update(self, data):
+        message_id = self.screen[0] if self.screen else next(self.api._message_ids)
+        return {"callback_query": {
+            "id": str(uuid.uuid4()),
+            "from": self._user(),
+            "chat_instance": str(self.user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": self._chat(),
+                "from": BOT_USER,
+                "text": "files",
+            },
+        }}
+
+    def send(self, update, replies):
+        """Deliver ``update`` and wait for the reply; returns (seconds, reply call) or (None, None)"""
+        start = self.api.mark(self.user_id)
+        started = time.perf_counter()
+        self.api.deliver(update)
+        call, _ = self.api.wait_for(self.user_id, replies, start, self.timeout)
+        if call is None:
+            return None, None
+        return time.perf_counter() - started, call
+
+    def seed(self, files):
+        """Upload ``files`` documents in bursts and open the file list; not measured"""
+        for chunk_start in range(0, files, SEED_CHUNK):
+            start = self.api.mark(self.user_id)
+            for _ in range(min(SEED_CHUNK, files - chunk_start)):
+                self.api.deliver(self.upload_update())
+            self.api.wait_for(self.user_id, ACTION_REPLIES["upload"], start, self.timeout)
+        self.run_action("myfiles", record=False)
+
+    def choose(self, action):
+        """Pick the update for ``action``; page and download fall back to /myfiles without a file list"""
+        callbacks = self.screen[1] if self.screen else []
+        if action == "upload":
+            return action, self.upload_update()
+        if action == "page":
+            pages = [data for data in callbacks if data.startswith(("files_next_", "files_prev_"))]
+            if pages:
+                return action, self.callback_update(random.choice(pages))
+        if action == "download":
+            files = [data for data in callbacks if data.startswith("dl_")]
+            if files:
+                return action, self.callback_update(random.choice(files))
+        return "myfiles", self.command_update("/myfiles")
+
+    def run_action(self, action, record=True):
+        action, update = self.choose(action)
+        seconds, call = self.send(update, ACTION_REPLIES[action])
+        if call is None:
+            self.timeouts[action] += 1
+            return
+        if record:
+            self.latencies[action].append(seconds)
+        callbacks = button_callbacks(call["params"])
+        if any(data.startswith("dl_") for data in callbacks):
+            self.screen = (call["message_id"] or call["params"].get("message_id"), callbacks)
+        elif action == "download":
+            # The file list was replaced by the download confirmation
+            self.screen = None
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        action, _, weight = part.partition("=")
+        action = action.strip()
+        if action not in ACTION_REPLIES:
+            raise argparse.ArgumentTypeError(f"unknown action {action!r}, expected one of {', '.join(ACTION_REPLIES)}")
+        mix[action] = float(weight or 1)
+    return mix
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def fetch_json(url):
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.loads(response.read())
+
+
+def db_queries(port):
+    """Total SQL statements run by the bot process, from its /metrics"""
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+        text = response.read().decode()
+    return sum(
+        float(line.rsplit(" ", 1)[1]) for line in text.splitlines() if line.startswith("db_queries_total")
+    )
+
+
+def start_bot(mode, api, args, port, database_url, log_file):
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "TELEGRAM_API_URL": api.url,
+        "DATABASE_URL": database_url,
+        # Empty values are not overridden by .env and count as unset
+        "NEON_DATABASE_URL": "",
+        "RENDER": "",
+        "WEBHOOK_URL": "",
+        "PORT": str(port),
+    })
+    if not args.telegram_limits:
+        env.update({"OUTBOUND_GLOBAL_RATE": "100000", "OUTBOUND_CHAT_RATE": "100000"})
+
+    if mode == "polling":
+        command = [sys.executable, "main.py"]
+    else:
+        env.update({
+            "WEBHOOK_URL": f"http://127.0.0.1:{port}/webhook/{BOT_TOKEN}",
+            "WEB_CONCURRENCY": str(args.workers),
+        })
+        command = [sys.executable, "-m", "gunicorn", "main:app", "-c", "gunicorn.conf.py"]
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+
+def wait_until_serving(mode, api, process, port, timeout):
+    """Wait until the bot takes updates: first getUpdates (polling) or a ready /health (webhook)"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            ready = fetch_json(f"http://127.0.0.1:{port}/health").get("ready")
+        except (urllib.error.URLError, OSError, ValueError):
+            ready = False
+        if ready and (api.polled.is_set() if mode == "polling" else api.webhook_url):
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def stop_bot(process):
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def run_mode(mode, args, workdir):
+    api = FakeBotAPI()
+    api.start()
+    port = free_port()
+    database_url = args.database or f"sqlite:///{os.path.join(workdir, f'bench-{mode}.db')}"
+    log_path = os.path.join(workdir, f"bench-{mode}.log")
+    with open(log_path, "w") as log_file:
+        process = start_bot(mode, api, args, port, database_url, log_file)
+        try:
+            if not wait_until_serving(mode, api, process, port, args.startup_timeout):
+                raise RuntimeError(f"{mode}: bot did not start")
+            return drive(mode, api, args, port, database_url)
+        except Exception:
+            # The work directory is removed on exit, so show the end of the bot's log here
+            log_file.flush()
+            with open(log_path) as f:
+                sys.stderr.write("".join(deque(f, maxlen=40)))
+            raise
+        finally:
+            stop_bot(process)
+            api.stop()
+
+
+def drive(mode, api, args, port, database_url):
+    run_id = uuid.uuid4().hex[:8]
+    # Separate user ids per mode, so both runs can share a Postgres database
+    user_base = args.user_base + (0 if mode == "polling" else 1_000_000)
+    users = [VirtualUser(api, user_base + index, run_id, args.timeout) for index in range(args.users)]
+
+    print(f"{mode}: seeding {args.users} users with {args.files} files each...", flush=True)
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        list(pool.map(lambda user: user.seed(args.files), users))
+
+    actions, weights = zip(*args.mix.items())
+    per_user = [args.updates // args.users + (index < args.updates % args.users) for index in range(args.users)]
+
+    def run_user(user, count):
+        rng = random.Random(f"{args.seed}-{user.user_id}")
+        for action in rng.choices(actions, weights, k=count):
+            user.run_action(action)
+
+    queries_before = db_queries(port)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        list(pool.map(run_user, users, per_user))
+    elapsed = time.perf_counter() - started
+    queries = db_queries(port) - queries_before
+
+    latencies = defaultdict(list)
+    timeouts = defaultdict(int)
+    for user in users:
+        for action, values in user.latencies.items():
+            latencies[action].extend(values)
+        for action, count in user.timeouts.items():
+            timeouts[action] += count
+    completed = sum(len(values) for values in latencies.values())
+
+    result = {
+        "mode": mode,
+        "database": database_url.split(":", 1)[0],
+        "users": args.users,
+        "updates": completed,
+        "timeouts": sum(timeouts.values()),
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(completed / elapsed, 2) if elapsed else 0,
+        "db_queries_per_update": round(queries / completed, 2) if completed else None,
+        "delivery_errors": api.delivery_errors,
+        "allowed_updates": api.allowed_updates,
+        "actions": {},
+    }
+    for action in ACTION_REPLIES:
+        values = latencies.get(action) or []
+        result["actions"][action] = {
+            "count": len(values),
+            "timeouts": timeouts.get(action, 0),
+            "p50_ms": round(percentile(values, 50) * 1000, 1) if values else None,
+            "p99_ms": round(percentile(values, 99) * 1000, 1) if values else None,
+        }
+    all_values = [value for values in latencies.values() for value in values]
+    result["actions"]["all"] = {
+        "count": len(all_values),
+        "timeouts": result["timeouts"],
+        "p50_ms": round(percentile(all_values, 50) * 1000, 1) if all_values else None,
+        "p99_ms": round(percentile(all_values, 99) * 1000, 1) if all_values else None,
+    }
+    return result
+
+
+def print_result(result):
+    print(
+        f"\n{result['mode']} ({result['database']}, {result['users']} users): "
+        f"{result['updates']} updates in {result['seconds']:.2f}s"
+    )
+    print(f"  updates/sec        {result['updates_per_second']:.1f}")
+    print(f"  db queries/update  {result['db_queries_per_update']}")
+    print(f"  allowed updates    {', '.join(result['allowed_updates'] or ['all'])}")
+    if result["timeouts"] or result["delivery_errors"]:
+        print(f"  timeouts {result['timeouts']}, webhook delivery errors {result['delivery_errors']}")
+    print(f"  {'action':<10}{'count':>7}{'p50 ms':>10}{'p99 ms':>10}")
+    for action, stats in result["actions"].items():
+        if not stats["count"]:
+            continue
+        print(f"  {action:<10}{stats['count']:>7}{stats['p50_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["polling", "webhook", "both"], default="both")
+    parser.add_argument("--users", type=int, default=20, help="virtual users sending concurrently")
+    parser.add_argument("--updates", type=int, default=1000, help="measured updates across all users")
+    parser.add_argument("--files", type=int, default=30, help="files each user uploads before measuring")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"action weights (default {DEFAULT_MIX})")
+    parser.add_argument("--database", help="database URL (default: a fresh SQLite file per mode)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="gunicorn workers in webhook mode; queries/update counts only the worker serving /metrics")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the production outbound rate limits")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for each reply")
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--user-base", type=int, default=900_000_000, help="first virtual user id")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the action sequence")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    modes = ["polling", "webhook"] if args.mode == "both" else [args.mode]
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        for mode in modes:
+            result = run_mode(mode, args, workdir)
+            print_result(result)
+            results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,604 +1,832 @@
+import os
+import time
 import logging
-from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ContextTypes, CommandHandler, MessageHandler, CallbackQueryHandler, filters
+from collections import namedtuple
+from datetime import datetime, timedelta
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup,
+    InlineQueryResultCachedAudio, InlineQueryResultCachedDocument, InlineQueryResultCachedPhoto,
+    InlineQueryResultCachedVideo, InlineQueryResultCachedVoice,
+    InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo,
+)
+from telegram.ext import (
+    ContextTypes, CommandHandler, MessageHandler, CallbackQueryHandler, InlineQueryHandler, TypeHandler,
+    filters,
+)
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
+
+from batching import UploadBatcher
+from cache import build_file_cache, build_page_cache
+from cleanup import MessageCleanup
+from metrics import HANDLER_DURATION, HANDLER_ERRORS, PAGE_CACHE_LOOKUPS, REGISTRY, UPDATES, register_cache
+from outbound import OutboundScheduler
+from repository import FileRepository
+from screens import ScreenRenderer
+from search import build_search_index, normalize_query
+from updates import ChatOrderedUpdateProcessor, UpdateRetry, is_transient
+from webhook import worker_count
+from templates import (
+    BATCH_UPLOAD_FAILED_TEXT, CALLBACK_ERROR_TEXT, DOWNLOAD_KEYBOARD, EMPTY_FILES,
+    FILE_LIST_FOOTER, FILE_NOT_FOUND_TEXT, FILES_ERROR_TEXT, HELP, NOTHING_SELECTED_TEXT,
+    SEARCH_FOOTER, SEARCH_USAGE_TEXT, SHOW_MY_FILES_KEYBOARD, STATIC_SCREENS, UNSUPPORTED_FILE_TEXT,
+    UPLOAD_FAILED_TEXT, WELCOME, Screen, batch_confirmation_text, bulk_item_caption, bulk_sent_text,
+    download_caption_text, download_done_text, file_list_header_text, inline_result_description,
+    no_search_results_text, search_results_header_text, upload_confirmation_text,
+)
 
 logger = logging.getLogger(__name__)
 
-
-def format_file_size(size_bytes):
-    """Format file size in human readable format"""
-    if size_bytes is None:
-        return "Unknown size"
+# An upload waiting in the batcher: who sent it, the message, the row to store,
+# and the update to retry if storing fails
+PendingUpload = namedtuple("PendingUpload", ["user_id", "message", "upload", "update"])
+
+# Bot API method and file argument used to send back each stored media kind
+SEND_METHODS = {
+    "document": ("send_document", "document"),
+    "photo": ("send_photo", "photo"),
+    "video": ("send_video", "video"),
+    "audio": ("send_audio", "audio"),
+    "voice": ("send_voice", "voice"),
+    "video_note": ("send_video_note", "video_note"),
+}
+
+# Media kinds that can share an album in send_media_group, and their InputMedia type
+MEDIA_GROUP_ALBUMS = {
+    "photo": "visual",
+    "video": "visual",
+    "audio": "audio",
+    "document": "document",
+}
+INPUT_MEDIA = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "audio": InputMediaAudio,
+    "document": InputMediaDocument,
+}
+
+# Cached inline result type and its file argument for each stored media kind;
+# Telegram has no inline result for video notes, so they are left out
+INLINE_RESULTS = {
+    "document": (InlineQueryResultCachedDocument, "document_file_id"),
+    "photo": (InlineQueryResultCachedPhoto, "photo_file_id"),
+    "video": (InlineQueryResultCachedVideo, "video_file_id"),
+    "audio": (InlineQueryResultCachedAudio, "audio_file_id"),
+    "voice": (InlineQueryResultCachedVoice, "voice_file_id"),
+}
+
+# Telegram's limit on results per inline query answer
+INLINE_RESULTS_LIMIT = 50
+
+# How long Telegram may reuse an inline answer; kept short because uploads change it
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", 10))
+
+# Callback data handled by handle_callback, by exact value and by prefix;
+# metrics label callbacks with these so the label set stays small
+CALLBACK_NAMES = {"my_files", "select_cancel", "send_selected", *STATIC_SCREENS}
+CALLBACK_PREFIXES = (
+    "files_next_", "files_prev_", "search_next_", "search_prev_",
+    "select_", "sel_", "sendall_", "dl_",
+)
+
+# The update type each kind of handler consumes; allowed_updates() subscribes
+# the bot to exactly the types the registered handlers need
+HANDLER_UPDATE_TYPES = {
+    CommandHandler: Update.MESSAGE,
+    MessageHandler: Update.MESSAGE,
+    CallbackQueryHandler: Update.CALLBACK_QUERY,
+    InlineQueryHandler: Update.INLINE_QUERY,
+}
+
+# Telegram's limit on items per media group
+MEDIA_GROUP_SIZE = 10
+
+# Files shown per /myfiles page
+FILES_PER_PAGE = 20
+
+# Reference point for pagination cursors (upload dates are stored as naive UTC)
+CURSOR_EPOCH = datetime(1970, 1, 1)
+
+
+def encode_cursor(file):
+    """Encode a file's (upload_date, id) position as a compact callback_data cursor"""
+    micros = (file.upload_date - CURSOR_EPOCH) // timedelta(microseconds=1)
+    return f"{_to_base36(micros)}.{_to_base36(file.id)}"
+
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor back into (upload_date, id)"""
+    micros, record_id = cursor.split(".")
+    return CURSOR_EPOCH + timedelta(microseconds=int(micros, 36)), int(record_id, 36)
+
+
+def _to_base36(number):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    encoded = ""
+    while True:
+        number, remainder = divmod(number, 36)
+        encoded = digits[remainder] + encoded
+        if number == 0:
+            return encoded
+
+
+async def send_stored_file(bot, chat_id, file_metadata, caption=None, reply_markup=None):
+    """Send a stored file back using the Bot API method for its media kind"""
+    method_name, file_argument = SEND_METHODS.get(file_metadata.media_kind, SEND_METHODS["document"])
+    kwargs = {"chat_id": chat_id, file_argument: file_metadata.file_id, "reply_markup": reply_markup}
+    # Video notes are the one kind that cannot carry a caption
+    if caption and file_metadata.media_kind != "video_note":
+        kwargs.update(caption=caption, parse_mode=ParseMode.HTML)
+    return await getattr(bot, method_name)(**kwargs)
+
+
+async def send_stored_files(bot, chat_id, files):
+    """Send several stored files, packed into albums of up to 10 where their kinds allow"""
+    albums = {}
+    singles = []
+    for file_metadata in files:
+        album = MEDIA_GROUP_ALBUMS.get(file_metadata.media_kind)
+        if album is None:
+            singles.append(file_metadata)
+        else:
+            albums.setdefault(album, []).append(file_metadata)
     
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if size_bytes < 1024.0:
-            return f"{size_bytes:.1f} {unit}"
-        size_bytes /= 1024.0
-    return f"{size_bytes:.1f} TB"
-
-
-def format_date(date_obj):
-    """Format date in a user-friendly way"""
-    if date_obj is None:
-        return "Unknown date"
-    return date_obj.strftime("%B %d, %Y at %I:%M %p")
-
-
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    for album_files in albums.values():
+        for start in range(0, len(album_files), MEDIA_GROUP_SIZE):
+            chunk = album_files[start:start + MEDIA_GROUP_SIZE]
+            if len(chunk) == 1:
+                # A media group needs at least two items
+                singles.extend(chunk)
+                continue
+            await bot.send_media_group(chat_id=chat_id, media=[
+                INPUT_MEDIA[file_metadata.media_kind](
+                    media=file_metadata.file_id,
+                    caption=bulk_item_caption(file_metadata),
+                    parse_mode=ParseMode.HTML
+                )
+                for file_metadata in chunk
+            ])
+    
+    for file_metadata in singles:
+        await send_stored_file(bot, chat_id, file_metadata, caption=bulk_item_caption(file_metadata))
+
+
+async def send_bulk(update, context, screens, files):
+    """Deliver a bulk selection and replace the file list with a summary"""
+    if not files:
+        await screens.show(update, Screen(NOTHING_SELECTED_TEXT, DOWNLOAD_KEYBOARD))
+        return
+    await send_stored_files(context.bot, update.effective_chat.id, files)
+    await screens.show(update, Screen(bulk_sent_text(len(files)), DOWNLOAD_KEYBOARD))
+
+
+def inline_result(file_metadata):
+    """Build a cached inline result that re-sends a stored file by its file_id, or None"""
+    result_type = INLINE_RESULTS.get(file_metadata.media_kind)
+    if result_type is None:
+        return None
+    result_class, file_argument = result_type
+    kwargs = {
+        "id": str(file_metadata.id),
+        file_argument: file_metadata.file_id,
+        "caption": bulk_item_caption(file_metadata),
+        "parse_mode": ParseMode.HTML,
+    }
+    # Cached audio results take their title from the file's own tags
+    if result_class is not InlineQueryResultCachedAudio:
+        # Titles are plain text (parse_mode covers the caption only), so the name is not escaped
+        kwargs["title"] = file_metadata.filename
+    if result_class in (InlineQueryResultCachedDocument, InlineQueryResultCachedPhoto, InlineQueryResultCachedVideo):
+        kwargs["description"] = inline_result_description(file_metadata)
+    return result_class(**kwargs)
+
+
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE, screens):
     """Handle /start command"""
-    welcome_text = """
-🌟 <b>Welcome to @SAN_mediabot!</b> 🌟
-
-🚀 <i>Your personal cloud storage assistant</i>
-
-<b>✨ What I can do for you:</b>
-📁 Store any type of file securely
-📋 Keep track of all your uploads
-💾 Easy file retrieval anytime
-🔍 Smart file management
-
-<b>🎯 Quick Commands:</b>
-/myfiles - 📂 View all your files
-/start - 🏠 Show this welcome message
-/help - ❓ Get detailed help
-
-<b>📤 Getting Started:</b>
-Simply send me any file and I'll store it safely for you!
-
-<i>Built with ❤️ for premium experience</i>
-"""
-    
-    keyboard = [
-        [
-            InlineKeyboardButton("📂 My Files", callback_data="my_files"),
-            InlineKeyboardButton("❓ Help", callback_data="help")
-        ],
-        [
-            InlineKeyboardButton("🚀 Upload First File", callback_data="upload_guide")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
-        welcome_text,
-        parse_mode=ParseMode.HTML,
-        reply_markup=reply_markup
-    )
+    await screens.show(update, WELCOME)
 
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE, screens):
     """Handle /help command"""
-    help_text = """
-🔧 <b>How to Use @SAN_mediabot</b> 🔧
-
-<b>📤 Uploading Files:</b>
-• Send any file directly to this chat
-• Supported: Documents, Images, Videos, Audio, etc.
-• Files are stored securely with metadata
-
-<b>📁 Managing Files:</b>
-• Use /myfiles to see all your uploaded files
-• Click any file button to download instantly
-• Files are organized by upload date
-
-<b>🔍 File Information:</b>
-• File name and size are preserved
-• Upload timestamp is recorded
-• Easy one-click download access
-
-<b>⚡ Pro Tips:</b>
-• Send multiple files at once
-• Use descriptive filenames for easy identification
-• Your files are private and secure
-
-<b>🆘 Need Support?</b>
-For any queries contact @takezo_5
-"""
-    
-    keyboard = [
-        [
-            InlineKeyboardButton("📂 View My Files", callback_data="my_files"),
-            InlineKeyboardButton("🏠 Home", callback_data="start")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
-        help_text,
-        parse_mode=ParseMode.HTML,
-        reply_markup=reply_markup
-    )
+    await screens.show(update, HELP)
 
 
-async def handle_file_upload(update: Update, context: ContextTypes.DEFAULT_TYPE, db, flask_app):
-    """Handle file uploads"""
+async def handle_file_upload(update: Update, context: ContextTypes.DEFAULT_TYPE, batcher):
+    """Handle file uploads by queueing them for batched storage"""
+    message = update.message
     try:
-        from models import FileMetadata
-        
         user_id = update.effective_user.id
-        message = update.message
         
         # Get file information based on message type
         file_obj = None
         filename = "unknown_file"
         detected_mime_type = None
+        media_kind = None
         
         if message.document:
             file_obj = message.document
+            media_kind = "document"
             filename = file_obj.file_name or "document"
             detected_mime_type = getattr(file_obj, 'mime_type', None)
         elif message.photo:
             file_obj = message.photo[-1]  # Get highest resolution
+            media_kind = "photo"
             filename = f"photo_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
             detected_mime_type = "image/jpeg"
         elif message.video:
             file_obj = message.video
+            media_kind = "video"
             filename = file_obj.file_name or f"video_{datetime.now().strftime('%Y%m%d_%H%M%S')}.mp4"
             detected_mime_type = getattr(file_obj, 'mime_type', "video/mp4")
         elif message.audio:
             file_obj = message.audio
+            media_kind = "audio"
             filename = file_obj.file_name or f"audio_{datetime.now().strftime('%Y%m%d_%H%M%S')}.mp3"
             detected_mime_type = getattr(file_obj, 'mime_type', "audio/mpeg")
         elif message.voice:
             file_obj = message.voice
+            media_kind = "voice"
             filename = f"voice_{datetime.now().strftime('%Y%m%d_%H%M%S')}.ogg"
             detected_mime_type = "audio/ogg"
         elif message.video_note:
             file_obj = message.video_note
+            media_kind = "video_note"
             filename = f"video_note_{datetime.now().strftime('%Y%m%d_%H%M%S')}.mp4"
             detected_mime_type = "video/mp4"
         
         if not file_obj:
-            await message.reply_text("❌ Sorry, I couldn't process this file type.")
+            await message.reply_text(UNSUPPORTED_FILE_TEXT)
             return
         
-        # Save to database
-        with flask_app.app_context():
-            # Check if file already exists for this user
-            existing_file = FileMetadata.query.filter_by(
-                user_id=user_id, 
-                file_id=file_obj.file_id
-            ).first()
-            
-            if existing_file:
-                # File already exists, return the existing record
-                file_metadata = existing_file
-                success_message = "File already exists in your storage!"
-            else:
-                # Create new file metadata record with proper exception handling
-                try:
-                    file_metadata = FileMetadata(
-                        user_id=user_id,
-                        file_id=file_obj.file_id,
-                        filename=filename,
-                        file_size=getattr(file_obj, 'file_size', None),
-                        mime_type=detected_mime_type or getattr(file_obj, 'mime_type', None)
-                    )
-                    db.session.add(file_metadata)
-                    db.session.commit()
-                    success_message = "File Uploaded Successfully!"
-                except Exception as e:
-                    db.session.rollback()
-                    # Try to get existing file if unique constraint failed
-                    existing_file = FileMetadata.query.filter_by(file_id=file_obj.file_id).first()
-                    if existing_file:
-                        file_metadata = existing_file
-                        success_message = "File already exists in your storage!"
-                    else:
-                        raise e
-            
-            # Get the file metadata for response
-            file_size = file_metadata.file_size
-            mime_type = file_metadata.mime_type or getattr(file_obj, 'mime_type', None)
-            upload_date = file_metadata.upload_date
+        # Albums are batched per media group, loose files per user and chat
+        if message.media_group_id:
+            batch_key = ("album", message.media_group_id)
+        else:
+            batch_key = ("user", user_id, message.chat_id)
         
-        # Success response with premium styling
-        success_text = f"""
-✅ <b>{success_message}</b>
+        batcher.add(batch_key, PendingUpload(user_id, message, {
+            'file_id': file_obj.file_id,
+            'file_unique_id': file_obj.file_unique_id,
+            'filename': filename,
+            'file_size': getattr(file_obj, 'file_size', None),
+            'mime_type': detected_mime_type or getattr(file_obj, 'mime_type', None),
+            'media_kind': media_kind,
+        }, update))
+        
+    except Exception as e:
+        logger.error(f"Error handling file upload: {str(e)}")
+        if is_transient(e):
+            # Retried by UpdateRetry, which tells the user if it gives up
+            raise
+        await message.reply_text(UPLOAD_FAILED_TEXT, parse_mode=ParseMode.HTML)
 
-📁 <b>File Details:</b>
-🔸 Name: <code>{filename}</code>
-🔸 Size: <code>{format_file_size(file_size)}</code>
-🔸 Type: <code>{mime_type or 'Unknown'}</code>
-🔸 Uploaded: <code>{format_date(upload_date)}</code>
 
-🎉 <i>Your file is safely stored! Use /myfiles to view and download all your files.</i>
+async def store_upload_batch(uploads, repo, cleanup, retry):
+    """Store a batch of queued uploads and confirm them with a single reply.
 
-💡 <b>Note:</b> Telegram supports files up to 2GB. For larger files, consider splitting them or using compression.
-"""
-        
-        # Create keyboard with "Show My Files" button
-        keyboard = [
-            [InlineKeyboardButton("📂 Show My Files", callback_data="my_files")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    Only storing is retried (through ``retry``, an UpdateRetry): the
+    confirmation may have reached the user even if sending it raised, so it
+    is never sent twice. If storing fails for good, the uploads are
+    dead-lettered and the batch gets one failure notice.
+    """
+    message = uploads[-1].message
+    try:
+        # Save to database in one transaction
+        results = await retry.call(repo.add_files, uploads[0].user_id, [pending.upload for pending in uploads])
+    except Exception as e:
+        logger.error(f"Error storing upload batch: {str(e)}")
+        attempts = retry.max_retries + 1 if is_transient(e) else 1
+        for pending in uploads:
+            await retry.dead_letter(pending.update, e, attempts, notify=False)
+        try:
+            await message.reply_text(
+                UPLOAD_FAILED_TEXT if len(uploads) == 1 else BATCH_UPLOAD_FAILED_TEXT,
+                parse_mode=ParseMode.HTML
+            )
+        except Exception as notify_error:
+            logger.warning(f"Could not tell the user about the failed upload batch: {notify_error}")
+        return
+    
+    try:
+        if len(results) == 1:
+            success_text = upload_confirmation_text(uploads[0].upload, *results[0])
+        else:
+            success_text = batch_confirmation_text([pending.upload for pending in uploads], results)
         
         # Send success message with "Show My Files" button
         await message.reply_text(
             success_text,
             parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
+            reply_markup=SHOW_MY_FILES_KEYBOARD
         )
         
-        # Delete the original file message for privacy after successful processing
-        try:
-            await message.delete()
-        except Exception as delete_error:
-            logger.warning(f"Could not delete user's file message: {str(delete_error)}")
-            # Continue execution even if delete fails (might be due to permissions)
+        # Delete the original file messages for privacy; this happens in the
+        # background so the upload is done as soon as the confirmation is sent
+        await cleanup.schedule(message.chat_id, [pending.message.message_id for pending in uploads])
         
     except Exception as e:
-        logger.error(f"Error handling file upload: {str(e)}")
-        await message.reply_text(
-            "❌ <b>Upload Failed</b>\n\n"
-            "Sorry, there was an error processing your file. Please try again.",
-            parse_mode=ParseMode.HTML
+        # The files are stored; they show up in /myfiles even without a confirmation
+        logger.error(f"Error confirming upload batch: {str(e)}")
+
+
+async def notify_failed_update(update, screens):
+    """Tell the user an update failed for good, after UpdateRetry gave up on it"""
+    if update.callback_query:
+        await screens.show(update, Screen(CALLBACK_ERROR_TEXT, None))
+    elif update.message and update.message.effective_attachment:
+        await update.message.reply_text(UPLOAD_FAILED_TEXT, parse_mode=ParseMode.HTML)
+    elif update.message:
+        await update.message.reply_text(CALLBACK_ERROR_TEXT, parse_mode=ParseMode.HTML)
+
+
+def parse_page_token(page_token):
+    """Split a page token into (before, after) cursors.
+
+    Tokens are "" for the newest page, "n<cursor>" for the page after a file
+    and "p<cursor>" for the page before one.
+    """
+    if not page_token:
+        return None, None
+    cursor = decode_cursor(page_token[1:])
+    if page_token[0] == "n":
+        return cursor, None
+    return None, cursor
+
+
+def file_button(file, selected=None):
+    """Button for one listed file: a download, or a checkbox in multi-select mode"""
+    file_emoji = "📄"
+    if file.mime_type:
+        if file.mime_type.startswith('image/'):
+            file_emoji = "🖼️"
+        elif file.mime_type.startswith('video/'):
+            file_emoji = "🎥"
+        elif file.mime_type.startswith('audio/'):
+            file_emoji = "🎵"
+        elif 'pdf' in file.mime_type:
+            file_emoji = "📋"
+    
+    # Truncate long filenames for button display
+    display_name = file.filename
+    if len(display_name) > 25:
+        display_name = display_name[:22] + "..."
+    
+    if selected is None:
+        return InlineKeyboardButton(f"{file_emoji} {display_name}", callback_data=f"dl_{file.id}")
+    mark = "✅" if file.id in selected else "⬜"
+    return InlineKeyboardButton(f"{mark} {display_name}", callback_data=f"sel_{file.id}")
+
+
+def navigation_row(page, prefix):
+    """Previous/next buttons for a page; callbacks are ``<prefix>_prev_`` / ``<prefix>_next_`` plus a cursor"""
+    navigation = []
+    if page.has_newer:
+        navigation.append(
+            InlineKeyboardButton("⬅️ Previous", callback_data=f"{prefix}_prev_{encode_cursor(page.files[0])}")
         )
+    if page.has_older:
+        navigation.append(
+            InlineKeyboardButton("➡️ Show More Files", callback_data=f"{prefix}_next_{encode_cursor(page.files[-1])}")
+        )
+    return navigation
+
+
+async def build_file_list(user_id, repo, page_token="", selected=None):
+    """Render one /myfiles page; passing ``selected`` ids renders it in multi-select mode"""
+    # Plain pages come from the repository's page cache while the user's files are unchanged
+    pages = repo.page_cache if selected is None else None
+    stats = None
+    if pages is not None:
+        if pages.shared:
+            # Other workers may have changed the files; their stats row is the version
+            stats = await repo.get_user_stats(user_id)
+        cached = pages.get(user_id, page_token, stats)
+        if cached is not None:
+            PAGE_CACHE_LOOKUPS.inc(result="hit")
+            return cached
+        PAGE_CACHE_LOOKUPS.inc(result="miss")
+        stamp = pages.stamp()
+        screen = await render_file_list(user_id, repo, page_token, stats=stats)
+        pages.set(user_id, page_token, screen, stats, stamp)
+        return screen
+    return await render_file_list(user_id, repo, page_token, selected)
+
+
+async def render_file_list(user_id, repo, page_token="", selected=None, stats=None):
+    """Query and render a /myfiles page; ``stats`` from get_user_stats saves reading the totals again"""
+    before, after = parse_page_token(page_token)
+    
+    # Query one page of the user's files
+    page = await repo.list_files_page(user_id, before=before, after=after, limit=FILES_PER_PAGE)
+    if not page.files and page_token:
+        # The cursor ran past the end (e.g. files were removed) - restart from the newest
+        page = await repo.list_files_page(user_id, limit=FILES_PER_PAGE)
+        page_token = ""
+    files = page.files
+    
+    if not files:
+        return EMPTY_FILES
+    
+    if stats is not None:
+        total_files, total_bytes = stats[:2]
+    else:
+        total_files, total_bytes = await repo.get_user_totals(user_id)
+    
+    # Create inline keyboard with file buttons (max 20 files per page)
+    keyboard = [[file_button(file, selected)] for file in files]
+    
+    if selected is not None:
+        keyboard.append([
+            InlineKeyboardButton(f"📥 Send Selected ({len(selected)})", callback_data="send_selected"),
+            InlineKeyboardButton("✖️ Cancel", callback_data="select_cancel")
+        ])
+        return Screen(file_list_header_text(total_files, total_bytes), InlineKeyboardMarkup(keyboard))
+    
+    # Add navigation and utility buttons
+    navigation = navigation_row(page, "files")
+    if navigation:
+        keyboard.append(navigation)
+    
+    keyboard.append([
+        InlineKeyboardButton("☑️ Select Files", callback_data=f"select_{page_token}"),
+        InlineKeyboardButton("📥 Send All on Page", callback_data=f"sendall_{page_token}")
+    ])
+    keyboard.append(FILE_LIST_FOOTER)
+    
+    return Screen(file_list_header_text(total_files, total_bytes), InlineKeyboardMarkup(keyboard))
 
 
-async def my_files_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db, flask_app):
-    """Handle /myfiles command"""
+async def my_files_command(update: Update, context: ContextTypes.DEFAULT_TYPE, repo, screens, page_token=""):
+    """Handle /myfiles command and its page navigation; buttons edit the list in place"""
     try:
-        from models import FileMetadata
-        
-        user_id = update.effective_user.id
+        screen = await build_file_list(update.effective_user.id, repo, page_token)
+        await screens.show(update, screen)
         
-        # Query user's files
-        with flask_app.app_context():
-            files = FileMetadata.query.filter_by(user_id=user_id).order_by(FileMetadata.upload_date.desc()).all()
-        
-        if not files:
-            empty_text = """
-📂 <b>Your File Storage is Empty</b>
-
-🌟 <i>Ready to get started?</i>
-
-Upload your first file by sending any document, image, video, or audio file to this chat!
-
-<b>✨ Pro Features:</b>
-• Unlimited file types supported
-• Instant download access
-• Secure cloud storage
-• Smart file organization
-"""
-            keyboard = [
-                [InlineKeyboardButton("📤 Upload Your First File", callback_data="upload_guide")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await update.effective_message.reply_text(
-                empty_text,
-                parse_mode=ParseMode.HTML,
-                reply_markup=reply_markup
-            )
-            return
-        
-        # Create file list with premium styling
-        header_text = f"""
-📂 <b>Your Premium File Storage</b>
+    except Exception as e:
+        logger.error(f"Error in my_files_command: {str(e)}")
+        if is_transient(e):
+            raise
+        await screens.show(update, Screen(FILES_ERROR_TEXT, None))
 
-🗂️ <i>Total Files: {len(files)}</i>
-📊 <i>Storage Used: {format_file_size(sum(f.file_size or 0 for f in files))}</i>
 
-💎 <b>Select any file to download:</b>
-"""
+async def build_search_results(user_id, repo, query, page_token=""):
+    """Render one page of /search results for an already normalized query"""
+    before, after = parse_page_token(page_token)
+    page = await repo.search_files_page(user_id, query, before=before, after=after, limit=FILES_PER_PAGE)
+    if not page.files and page_token:
+        page = await repo.search_files_page(user_id, query, limit=FILES_PER_PAGE)
+    
+    if not page.files:
+        return Screen(no_search_results_text(query), InlineKeyboardMarkup([SEARCH_FOOTER]))
+    
+    keyboard = [[file_button(file)] for file in page.files]
+    navigation = navigation_row(page, "search")
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append(SEARCH_FOOTER)
+    
+    return Screen(search_results_header_text(query), InlineKeyboardMarkup(keyboard))
+
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE, repo, screens, page_token=""):
+    """Handle /search <query> and its page navigation"""
+    try:
+        if page_token:
+            # Paging through earlier results; the query is kept in the database
+            # because it may not fit in the 64 bytes of callback_data
+            query = await repo.get_search_query(update.effective_user.id)
+        else:
+            query = normalize_query(" ".join(context.args or []))
+            await repo.set_search_query(update.effective_user.id, query)
         
-        # Create inline keyboard with file buttons (max 20 files per page)
-        keyboard = []
-        for i, file in enumerate(files[:20]):
-            file_emoji = "📄"
-            if file.mime_type:
-                if file.mime_type.startswith('image/'):
-                    file_emoji = "🖼️"
-                elif file.mime_type.startswith('video/'):
-                    file_emoji = "🎥"
-                elif file.mime_type.startswith('audio/'):
-                    file_emoji = "🎵"
-                elif 'pdf' in file.mime_type:
-                    file_emoji = "📋"
-            
-            # Truncate long filenames for button display
-            display_name = file.filename
-            if len(display_name) > 25:
-                display_name = display_name[:22] + "..."
-            
-            button_text = f"{file_emoji} {display_name}"
-            keyboard.append([
-                InlineKeyboardButton(
-                    button_text,
-                    callback_data=f"dl_{file.id}"
-                )
-            ])
+        if not query:
+            await screens.show(update, Screen(SEARCH_USAGE_TEXT, None))
+            return
         
-        # Add navigation and utility buttons
-        if len(files) > 20:
-            keyboard.append([
-                InlineKeyboardButton("➡️ Show More Files", callback_data="files_page_2")
-            ])
+        screen = await build_search_results(update.effective_user.id, repo, query, page_token)
+        await screens.show(update, screen)
         
-        keyboard.append([
-            InlineKeyboardButton("📤 Upload New File", callback_data="upload_guide"),
-            InlineKeyboardButton("🔄 Refresh", callback_data="my_files")
-        ])
+    except Exception as e:
+        logger.error(f"Error in search_command: {str(e)}")
+        if is_transient(e):
+            raise
+        await screens.show(update, Screen(FILES_ERROR_TEXT, None))
+
+
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, repo):
+    """Answer ``@bot <name>`` with the user's files whose names start with the text"""
+    inline_query = update.inline_query
+    try:
+        query = normalize_query(inline_query.query)
+        # The offset is the keyset cursor of the last file already shown
+        before = decode_cursor(inline_query.offset) if inline_query.offset else None
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        if query:
+            page = await repo.search_files_page(
+                update.effective_user.id, query, before=before,
+                limit=INLINE_RESULTS_LIMIT, prefix=True, full_rows=True
+            )
+        else:
+            page = await repo.list_files_page(
+                update.effective_user.id, before=before, limit=INLINE_RESULTS_LIMIT, full_rows=True
+            )
         
-        await update.effective_message.reply_text(
-            header_text,
-            parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
+        results = [result for result in map(inline_result, page.files) if result is not None]
+        next_offset = encode_cursor(page.files[-1]) if page.has_older else ""
+        await inline_query.answer(
+            results,
+            cache_time=INLINE_CACHE_TIME,
+            is_personal=True,
+            next_offset=next_offset
         )
         
     except Exception as e:
-        logger.error(f"Error in my_files_command: {str(e)}")
-        await update.effective_message.reply_text(
-            "❌ <b>Error Loading Files</b>\n\n"
-            "Sorry, there was an error retrieving your files. Please try again.",
-            parse_mode=ParseMode.HTML
-        )
+        logger.error(f"Error in inline_query_handler: {str(e)}")
+        if is_transient(e):
+            raise
 
 
-async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db, flask_app):
-    """Handle callback queries from inline buttons"""
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, repo, screens):
+    """Handle callback queries from inline buttons; screens replace the tapped message"""
     query = update.callback_query
-    await query.answer()
+    try:
+        await query.answer()
+    except BadRequest as e:
+        # A retried update's query was answered on the first attempt, or has expired
+        logger.info(f"Could not answer callback query: {e}")
     
+    # Set once a file may have gone out; from then on the update is never run again
+    sending = False
     try:
-        if query.data == "start":
-            welcome_text = """
-🌟 <b>Welcome to @SAN_mediabot!</b> 🌟
-
-🚀 <i>Your personal cloud storage assistant</i>
-
-<b>✨ What I can do for you:</b>
-📁 Store any type of file securely
-📋 Keep track of all your uploads
-💾 Easy file retrieval anytime
-🔍 Smart file management
-
-<b>🎯 Quick Commands:</b>
-/myfiles - 📂 View all your files
-/start - 🏠 Show this welcome message
-/help - ❓ Get detailed help
-
-<b>📤 Getting Started:</b>
-Simply send me any file and I'll store it safely for you!
-
-<i>Built with ❤️ for premium experience</i>
-"""
-            
-            keyboard = [
-                [
-                    InlineKeyboardButton("📂 My Files", callback_data="my_files"),
-                    InlineKeyboardButton("❓ Help", callback_data="help")
-                ],
-                [
-                    InlineKeyboardButton("🚀 Upload First File", callback_data="upload_guide")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                welcome_text,
-                parse_mode=ParseMode.HTML,
-                reply_markup=reply_markup
-            )
-        elif query.data == "help":
-            help_text = """
-🔧 <b>How to Use @SAN_mediabot</b> 🔧
-
-<b>📤 Uploading Files:</b>
-• Send any file directly to this chat
-• Supported: Documents, Images, Videos, Audio, etc.
-• Files are stored securely with metadata
-
-<b>📁 Managing Files:</b>
-• Use /myfiles to see all your uploaded files
-• Click any file button to download instantly
-• Files are organized by upload date
-
-<b>🔍 File Information:</b>
-• File name and size are preserved
-• Upload timestamp is recorded
-• Easy one-click download access
-
-<b>⚡ Pro Tips:</b>
-• Send multiple files at once
-• Use descriptive filenames for easy identification
-• Your files are private and secure
-
-<b>🆘 Need Support?</b>
-For any queries contact @takezo_5
-"""
-            
-            keyboard = [
-                [
-                    InlineKeyboardButton("📂 View My Files", callback_data="my_files"),
-                    InlineKeyboardButton("🏠 Home", callback_data="start")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                help_text,
-                parse_mode=ParseMode.HTML,
-                reply_markup=reply_markup
-            )
+        if query.data in STATIC_SCREENS:
+            await screens.show(update, STATIC_SCREENS[query.data])
         elif query.data == "my_files":
-            await my_files_command(update, context, db, flask_app)
-        elif query.data == "upload_guide":
-            guide_text = """
-📤 <b>How to Upload Files</b>
-
-🎯 <i>It's super simple!</i>
-
-<b>Just send me any file:</b>
-• 📄 Documents (PDF, DOC, TXT, etc.)
-• 🖼️ Images (JPG, PNG, GIF, etc.)
-• 🎥 Videos (MP4, AVI, MOV, etc.)
-• 🎵 Audio (MP3, WAV, OGG, etc.)
-• 🗣️ Voice messages
-• 📹 Video notes
-
-<b>✨ Pro Tips:</b>
-• Send multiple files at once
-• Original quality is preserved
-• Instant secure storage
-• One-click download later
-
-<i>Ready? Send your first file now! 🚀</i>
-"""
-            keyboard = [
-                [InlineKeyboardButton("📂 View My Files", callback_data="my_files")],
-                [InlineKeyboardButton("🏠 Back to Home", callback_data="start")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                guide_text,
-                parse_mode=ParseMode.HTML,
-                reply_markup=reply_markup
+            await my_files_command(update, context, repo, screens)
+        elif query.data.startswith("files_next_"):
+            await my_files_command(update, context, repo, screens, "n" + query.data[len("files_next_"):])
+        elif query.data.startswith("files_prev_"):
+            await my_files_command(update, context, repo, screens, "p" + query.data[len("files_prev_"):])
+        elif query.data.startswith("search_next_"):
+            await search_command(update, context, repo, screens, "n" + query.data[len("search_next_"):])
+        elif query.data.startswith("search_prev_"):
+            await search_command(update, context, repo, screens, "p" + query.data[len("search_prev_"):])
+        elif query.data == "select_cancel":
+            # Leave multi-select mode and show the page as it was
+            selection = await repo.get_selection(update.effective_user.id)
+            await repo.clear_selection(update.effective_user.id)
+            page_token = selection.page if selection else ""
+            await screens.show(update, await build_file_list(update.effective_user.id, repo, page_token))
+        elif query.data.startswith("select_"):
+            # Enter multi-select mode for this page; the selection is stored in
+            # the database, so any worker can handle the next tap
+            page_token = query.data[len("select_"):]
+            await repo.start_selection(update.effective_user.id, page_token)
+            await screens.show(update, await build_file_list(update.effective_user.id, repo, page_token, selected=set()))
+        elif query.data.startswith("sel_"):
+            record_id = int(query.data[len("sel_"):])
+            selection = await repo.toggle_selected(update.effective_user.id, record_id)
+            screen = await build_file_list(
+                update.effective_user.id, repo, selection.page, selected=selection.ids
             )
+            await screens.show(update, screen)
+        elif query.data == "send_selected":
+            selection = await repo.get_selection(update.effective_user.id)
+            record_ids = sorted(selection.ids) if selection else []
+            files = await repo.get_files(update.effective_user.id, record_ids) if record_ids else []
+            await repo.clear_selection(update.effective_user.id)
+            sending = True
+            await send_bulk(update, context, screens, files)
+        elif query.data.startswith("sendall_"):
+            before, after = parse_page_token(query.data[len("sendall_"):])
+            page = await repo.list_files_page(
+                update.effective_user.id, before=before, after=after,
+                limit=FILES_PER_PAGE, full_rows=True
+            )
+            sending = True
+            await send_bulk(update, context, screens, page.files)
         elif query.data.startswith("dl_"):
-            from models import FileMetadata
-            
             record_id = query.data.replace("dl_", "")
             
             # Get file metadata by database ID
-            with flask_app.app_context():
-                file_metadata = FileMetadata.query.get(int(record_id))
+            file_metadata = await repo.get_file(int(record_id))
             
             if not file_metadata:
-                await query.edit_message_text("❌ File not found or has been deleted.")
+                await screens.show(update, Screen(FILE_NOT_FOUND_TEXT, None))
                 return
             
             # Send the file
-            download_text = f"""
-💾 <b>Downloading: {file_metadata.filename}</b>
-
-📊 <b>File Info:</b>
-🔸 Size: <code>{format_file_size(file_metadata.file_size)}</code>
-🔸 Uploaded: <code>{format_date(file_metadata.upload_date)}</code>
-
-⬇️ <i>File sent successfully!</i>
-"""
-            
-            keyboard = [
-                [
-                    InlineKeyboardButton("📂 Back to Files", callback_data="my_files"),
-                    InlineKeyboardButton("📤 Upload New", callback_data="upload_guide")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            # Send the actual file - detect type from file_id or filename
-            file_id = file_metadata.file_id
-            filename = file_metadata.filename.lower() if file_metadata.filename else ""
+            download_text = download_caption_text(file_metadata)
+            reply_markup = DOWNLOAD_KEYBOARD
             
-            # Detect if it's a photo based on file_id pattern or extension
-            is_photo = (file_id.startswith('AgAC') or 
-                       filename.endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp')) or
-                       (file_metadata.mime_type and file_metadata.mime_type.startswith('image/')))
-            
-            is_video = (file_id.startswith('BAACAgI') or 
-                       filename.endswith(('.mp4', '.avi', '.mov', '.mkv', '.webm')) or
-                       (file_metadata.mime_type and file_metadata.mime_type.startswith('video/')))
-            
-            is_audio = (file_id.startswith('AwACAgI') or 
-                       filename.endswith(('.mp3', '.wav', '.ogg', '.m4a', '.flac')) or
-                       (file_metadata.mime_type and file_metadata.mime_type.startswith('audio/')))
-            
-            try:
-                if is_photo:
-                    await context.bot.send_photo(
-                        chat_id=query.message.chat.id,
-                        photo=file_metadata.file_id,
-                        caption=download_text,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=reply_markup
-                    )
-                elif is_video:
-                    await context.bot.send_video(
-                        chat_id=query.message.chat.id,
-                        video=file_metadata.file_id,
-                        caption=download_text,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=reply_markup
-                    )
-                elif is_audio:
-                    await context.bot.send_audio(
-                        chat_id=query.message.chat.id,
-                        audio=file_metadata.file_id,
-                        caption=download_text,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=reply_markup
-                    )
-                else:
-                    # Default to document for all other file types
-                    await context.bot.send_document(
-                        chat_id=query.message.chat.id,
-                        document=file_metadata.file_id,
-                        caption=download_text,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=reply_markup
-                    )
-            except Exception as e:
-                # If specific method fails, try as document
-                logger.error(f"Failed to send file as detected type, trying as document: {e}")
-                await context.bot.send_document(
-                    chat_id=query.message.chat.id,
-                    document=file_metadata.file_id,
-                    caption=download_text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=reply_markup
-                )
+            # Send the actual file with the method matching its stored kind
+            sending = True
+            await send_stored_file(
+                context.bot,
+                update.effective_chat.id,
+                file_metadata,
+                caption=download_text,
+                reply_markup=reply_markup
+            )
             
             # Update the original message
-            await query.edit_message_text(
-                f"✅ <b>File Downloaded!</b>\n\n📁 <code>{file_metadata.filename}</code> has been sent to you.",
-                parse_mode=ParseMode.HTML
-            )
+            await screens.show(update, Screen(download_done_text(file_metadata), None))
             
     except Exception as e:
         logger.error(f"Error in handle_callback: {str(e)}")
-        await query.edit_message_text(
-            "❌ <b>Error</b>\n\nSorry, there was an error processing your request."
-        )
+        if sending:
+            # The file may have been delivered; the user can tap again if not
+            return
+        if is_transient(e):
+            raise
+        await screens.show(update, Screen(CALLBACK_ERROR_TEXT, None))
+
+
+def allowed_updates(application):
+    """Update types the registered handlers respond to, for getUpdates and setWebhook.
+
+    Observers such as the metrics TypeHandler are skipped. A handler class
+    missing from HANDLER_UPDATE_TYPES subscribes the bot to every type.
+    """
+    update_types = set()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, TypeHandler):
+                continue
+            update_type = HANDLER_UPDATE_TYPES.get(type(handler))
+            if update_type is None:
+                return list(Update.ALL_TYPES)
+            update_types.add(update_type)
+    return sorted(update_types)
+
+
+def callback_kind(data):
+    """The route a callback query takes in handle_callback, e.g. ``dl`` for ``dl_42``"""
+    if data in CALLBACK_NAMES:
+        return data
+    for prefix in CALLBACK_PREFIXES:
+        if data.startswith(prefix):
+            return prefix.rstrip("_")
+    return "other"
+
+
+def timed_callback(handler):
+    """Wrap a handler's callback to record its latency and errors under a per-handler label"""
+    callback = handler.callback
+    if isinstance(handler, CommandHandler):
+        label = "/" + sorted(handler.commands)[0]
+    else:
+        label = callback.__name__.removesuffix("_wrapper")
+    
+    async def timed(update, context):
+        handler_label = label
+        if isinstance(handler, CallbackQueryHandler) and update.callback_query:
+            handler_label = f"callback:{callback_kind(update.callback_query.data or '')}"
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=handler_label)
+            raise
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - started, handler=handler_label)
+    
+    timed.instrumented = True
+    return timed
+
+
+def instrument_handlers(application):
+    """Time every handler registered so far; new handlers need no metrics code of their own"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if not getattr(handler.callback, "instrumented", False):
+                handler.callback = timed_callback(handler)
+
+
+async def count_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Count every incoming update by kind"""
+    if update.callback_query:
+        kind = "callback_query"
+    elif update.inline_query:
+        kind = "inline_query"
+    elif update.message:
+        kind = "message"
+    else:
+        kind = "other"
+    UPDATES.inc(kind=kind)
 
 
 def setup_bot_handlers(application, database, flask_app):
     """Setup all bot handlers"""
-    # Wrap handlers to include database and flask app
+    # Handlers reach Telegram only through application.bot, so the scheduler
+    # installed as its rate limiter paces every outbound call
+    if not isinstance(application.bot.rate_limiter, OutboundScheduler):
+        logger.warning("Application has no OutboundScheduler; outbound Telegram calls are not rate limited")
+    
+    # All database access goes through the repository's thread pool
+    repo = FileRepository(
+        database, flask_app,
+        file_cache=build_file_cache(),
+        search_index=build_search_index(database),
+        # With several workers sharing the database, each keeps its own pages
+        page_cache=build_page_cache(shared=worker_count() > 1)
+    )
+    
+    # Screens edit the message whose button was tapped, skipping no-op edits;
+    # with several workers another one may have edited the message since
+    screens = ScreenRenderer(shared=worker_count() > 1)
+    
+    # Uploaded messages are removed later, in batches, by a background queue
+    cleanup = MessageCleanup(application.bot, repo)
+    
+    # Transient failures propagate out of the handlers (and out of batch
+    # storage) to be retried, then stored in failed_updates
+    async def notify_failure(update):
+        await notify_failed_update(update, screens)
+    
+    retry = UpdateRetry(application, repo, notify=notify_failure)
+    
+    # Uploads arriving in bursts are stored and confirmed together
+    async def flush_uploads(uploads):
+        await store_upload_batch(uploads, repo, cleanup, retry)
+    
+    batcher = UploadBatcher(flush_uploads)
+    
+    async def on_startup(application):
+        # Picks up deletions left over from a previous run
+        cleanup.start()
+    
+    async def on_stop(application):
+        await batcher.drain()
+        await cleanup.drain()
+    
+    application.post_init = on_startup
+    application.post_stop = on_stop
+    
+    # Wrap handlers to include the repository
     async def start_wrapper(update, context):
-        await start_command(update, context)
+        await start_command(update, context, screens)
     
     async def help_wrapper(update, context):
-        await help_command(update, context)
+        await help_command(update, context, screens)
     
-    async def file_wrapper(update, context):
-        await handle_file_upload(update, context, database, flask_app)
+    async def upload_wrapper(update, context):
+        await handle_file_upload(update, context, batcher)
     
     async def myfiles_wrapper(update, context):
-        await my_files_command(update, context, database, flask_app)
+        await my_files_command(update, context, repo, screens)
+    
+    async def search_wrapper(update, context):
+        await search_command(update, context, repo, screens)
+    
+    async def inline_wrapper(update, context):
+        await inline_query_handler(update, context, repo)
     
     async def callback_wrapper(update, context):
-        await handle_callback(update, context, database, flask_app)
+        await handle_callback(update, context, repo, screens)
     
     # Add handlers
     application.add_handler(CommandHandler("start", start_wrapper))
     application.add_handler(CommandHandler("help", help_wrapper))
     application.add_handler(CommandHandler("myfiles", myfiles_wrapper))
+    application.add_handler(CommandHandler("search", search_wrapper))
     
     # Handle all types of files
     application.add_handler(MessageHandler(
         filters.Document.ALL | filters.PHOTO | filters.VIDEO | 
         filters.AUDIO | filters.VOICE | filters.VIDEO_NOTE,
-        file_wrapper
+        upload_wrapper
     ))
     
     # Handle callback queries
     application.add_handler(CallbackQueryHandler(callback_wrapper))
     
+    # Share stored files in any chat via @bot <name>
+    application.add_handler(InlineQueryHandler(inline_wrapper))
+    
+    application.add_error_handler(retry)
+    
+    # Metrics: latency per handler, updates by kind, and queue depths
+    instrument_handlers(application)
+    application.add_handler(TypeHandler(Update, count_update), group=-1)
+    REGISTRY.gauge("bot_update_queue_size", "Updates waiting to be processed", application.update_queue.qsize)
+    if isinstance(application.update_processor, ChatOrderedUpdateProcessor):
+        processor = application.update_processor
+        REGISTRY.gauge(
+            "bot_updates_waiting", "Updates waiting for their chat's previous update or a free slot",
+            lambda: processor.pending
+        )
+    REGISTRY.gauge("upload_batcher_pending", "Uploads waiting in open batches", lambda: batcher.pending)
+    REGISTRY.gauge("message_cleanup_pending", "Messages queued for deletion", lambda: cleanup.pending)
+    if isinstance(application.bot.rate_limiter, OutboundScheduler):
+        scheduler = application.bot.rate_limiter
+        REGISTRY.gauge(
+            "telegram_outbound_queue_depth", "Bot API calls waiting for a rate limit token",
+            lambda: scheduler.queue_depth
+        )
+    register_cache("file", repo.file_cache)
+    register_cache("page", repo.page_cache)
+    register_cache("screen", screens)
+    if repo.search_index is not None:
+        register_cache("search", repo.search_index)
+    
     logger.info("Bot handlers setup complete")
@@ -0,0 +1,258 @@
+import os
+import time
+import pickle
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class LRUCache:
+    """In-process LRU cache whose entries also expire after ``ttl`` seconds"""
+
+    def __init__(self, max_entries=1024, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        """Like get(), but neither counted in the stats nor marked as recently used"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return default
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Counters for monitoring the hit rate"""
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class MemoryBackend:
+    """In-memory stand-in for a shared cache backend, for tests and single-process runs"""
+
+    def __init__(self):
+        self._values = {}
+
+    async def get(self, key):
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        expires_at, data = entry
+        if expires_at <= time.monotonic():
+            self._values.pop(key, None)
+            return None
+        return data
+
+    async def set(self, key, data, ttl):
+        self._values[key] = (time.monotonic() + ttl, data)
+
+    async def delete(self, key):
+        self._values.pop(key, None)
+
+
+class RedisBackend:
+    """Shared cache backend so several webhook workers see the same entries"""
+
+    def __init__(self, url, prefix="telegram-file-bot:"):
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("CACHE_REDIS_URL is set but the 'redis' package is not installed") from e
+        self._client = redis.from_url(url)
+        self.prefix = prefix
+
+    async def get(self, key):
+        return await self._client.get(self.prefix + key)
+
+    async def set(self, key, data, ttl):
+        await self._client.set(self.prefix + key, data, ex=int(ttl))
+
+    async def delete(self, key):
+        await self._client.delete(self.prefix + key)
+
+
+class ReadThroughCache:
+    """An LRUCache in front of an optional shared backend and a loader.
+
+    Lookups try the local LRU first, then the shared backend, and only call the
+    loader (the database) when both miss. Values must be picklable to be stored
+    in the backend. Backend failures are logged and treated as misses, so a
+    broken shared cache never breaks reads.
+    """
+
+    def __init__(self, local, backend=None):
+        self.local = local
+        self.backend = backend
+        self.backend_hits = 0
+
+    async def get_or_load(self, key, loader):
+        value = self.local.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        if self.backend is not None:
+            try:
+                data = await self.backend.get(key)
+            except Exception as e:
+                logger.warning(f"Shared cache read failed for {key}: {e}")
+                data = None
+            if data is not None:
+                value = pickle.loads(data)
+                self.local.set(key, value)
+                self.backend_hits += 1
+                return value
+
+        value = await loader()
+        if value is not None:
+            self.local.set(key, value)
+            if self.backend is not None:
+                try:
+                    await self.backend.set(key, pickle.dumps(value), self.local.ttl)
+                except Exception as e:
+                    logger.warning(f"Shared cache write failed for {key}: {e}")
+        return value
+
+    async def invalidate(self, key):
+        self.local.delete(key)
+        if self.backend is not None:
+            try:
+                await self.backend.delete(key)
+            except Exception as e:
+                logger.warning(f"Shared cache delete failed for {key}: {e}")
+
+    def stats(self):
+        stats = self.local.stats()
+        stats["backend_hits"] = self.backend_hits
+        return stats
+
+
+class PageCache:
+    """Rendered pages (e.g. /myfiles screens) per user, keyed by page token.
+
+    Holds up to ``max_pages`` pages for each of the ``max_users`` most
+    recently active users, for ``ttl`` seconds. ``invalidate(user_id)`` drops
+    all of a user's pages and must be called whenever their files change.
+    A page rendered while an invalidation happened is not stored: take
+    ``stamp()`` before reading the data and pass it to ``set()``.
+
+    With ``shared`` set, other processes (e.g. gunicorn workers) change the
+    same users' files and cannot call invalidate() here. Callers then store
+    each page with a ``version`` (e.g. the user's stats) and look it up with
+    the current one; a different version misses.
+    """
+
+    def __init__(self, max_users=1000, max_pages=5, ttl=600, shared=False):
+        self.max_pages = max_pages
+        self.shared = shared
+        self._users = LRUCache(max_entries=max_users, ttl=ttl)
+        self._invalidations = 0
+
+    def get(self, user_id, page_token, version=None):
+        pages = self._users.get(user_id)
+        if pages is None:
+            return None
+        entry = pages.get(page_token)
+        if entry is None or entry[0] != version:
+            return None
+        pages.move_to_end(page_token)
+        return entry[1]
+
+    def stamp(self):
+        return self._invalidations
+
+    def set(self, user_id, page_token, page, version=None, stamp=None):
+        if stamp is not None and stamp != self._invalidations:
+            # Some user's files changed while the page was rendered; it may be stale
+            return
+        pages = self._users.peek(user_id)
+        if pages is None:
+            pages = OrderedDict()
+            self._users.set(user_id, pages)
+        pages[page_token] = (version, page)
+        pages.move_to_end(page_token)
+        while len(pages) > self.max_pages:
+            pages.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._invalidations += 1
+        self._users.delete(user_id)
+
+    def stats(self):
+        return self._users.stats()
+
+
+def build_page_cache(shared=False):
+    """Create the rendered page cache from the PAGE_CACHE_* settings"""
+    return PageCache(
+        max_users=int(os.environ.get("PAGE_CACHE_USERS", 1000)),
+        max_pages=int(os.environ.get("PAGE_CACHE_PAGES", 5)),
+        ttl=float(os.environ.get("PAGE_CACHE_TTL", 600)),
+        shared=shared
+    )
+
+
+def build_file_cache():
+    """Create the file metadata cache from FILE_CACHE_* and CACHE_REDIS_URL settings.
+
+    ``CACHE_REDIS_URL=memory://`` uses a MemoryBackend instead of Redis, which
+    exercises the shared-cache path without a server.
+    """
+    local = LRUCache(
+        max_entries=int(os.environ.get("FILE_CACHE_SIZE", 1024)),
+        ttl=float(os.environ.get("FILE_CACHE_TTL", 3600))
+    )
+    backend = None
+    redis_url = os.environ.get("CACHE_REDIS_URL")
+    if redis_url == "memory://":
+        backend = MemoryBackend()
+    elif redis_url:
+        backend = RedisBackend(redis_url)
+    return ReadThroughCache(local, backend)
@@ -0,0 +1,124 @@
+import os
+import asyncio
+import logging
+
+from telegram.error import BadRequest, Forbidden, TelegramError
+
+logger = logging.getLogger(__name__)
+
+# Telegram accepts at most this many ids per deleteMessages call
+DELETE_BATCH_SIZE = 100
+
+
+class MessageCleanup:
+    """Background queue that removes uploaded messages in per-chat batches.
+
+    ``schedule()`` records the ids in the pending_deletions table and queues
+    them. The worker lets ids from the same burst collect for ``interval``
+    seconds, then removes them with one deleteMessages call per chat. Rows
+    that are still in the table are swept every ``retry_interval`` seconds,
+    up to ``max_attempts`` times. That covers failed deletions, ids left
+    behind by a restart, and ids queued by other workers that stopped. A
+    sweep claims its rows for ``retry_interval`` seconds, so workers do not
+    sweep the same rows twice.
+    """
+
+    def __init__(self, bot, repo, interval=None, retry_interval=None, max_attempts=5):
+        self.bot = bot
+        self.repo = repo
+        self.interval = interval if interval is not None else float(os.environ.get("CLEANUP_INTERVAL", 2.0))
+        self.retry_interval = retry_interval if retry_interval is not None else float(os.environ.get("CLEANUP_RETRY_INTERVAL", 60))
+        self.max_attempts = max_attempts
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._task = None
+
+    @property
+    def pending(self):
+        """Message ids queued but not yet sent to Telegram"""
+        return sum(len(message_ids) for message_ids in self._pending.values())
+
+    def start(self):
+        """Start the worker on the running loop, or restart it if it died (idempotent)"""
+        if self._task is None or (self._task.done() and not self._closing):
+            self._closing = False
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def schedule(self, chat_id, message_ids):
+        """Record messages of a chat in pending_deletions and queue them for deletion"""
+        try:
+            # Sweeps leave the rows alone until this worker had its chance to delete them
+            await self.repo.add_pending_deletions(chat_id, message_ids, delay=self.retry_interval)
+        except Exception as e:
+            logger.warning(f"Could not persist pending deletions for chat {chat_id}: {e}")
+        self._pending.setdefault(chat_id, []).extend(message_ids)
+        self._wakeup.set()
+        self.start()
+
+    async def drain(self):
+        """Process everything queued now and stop the worker, e.g. before shutting down"""
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            await self._retry_due()
+        except Exception as e:
+            # e.g. the database is not reachable yet; the next sweep tries again
+            logger.error(f"Error sweeping pending deletions at startup: {e}")
+        last_retry = loop.time()
+
+        while not self._closing or self._pending:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.retry_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                if self._pending:
+                    if not self._closing:
+                        # Let ids from the same burst of uploads accumulate
+                        await asyncio.sleep(self.interval)
+                    await self._flush()
+                if loop.time() - last_retry >= self.retry_interval:
+                    last_retry = loop.time()
+                    await self._retry_due()
+            except Exception as e:
+                logger.error(f"Error in message cleanup worker: {e}")
+
+    async def _flush(self):
+        pending, self._pending = self._pending, {}
+        for chat_id, message_ids in pending.items():
+            await self._delete(chat_id, message_ids)
+
+    async def _retry_due(self):
+        by_chat = {}
+        for chat_id, message_id in await self.repo.claim_due_pending_deletions(self.retry_interval):
+            by_chat.setdefault(chat_id, []).append(message_id)
+        for chat_id, message_ids in by_chat.items():
+            await self._delete(chat_id, message_ids)
+
+    async def _delete(self, chat_id, message_ids):
+        for start in range(0, len(message_ids), DELETE_BATCH_SIZE):
+            chunk = message_ids[start:start + DELETE_BATCH_SIZE]
+            try:
+                await self.bot.delete_messages(chat_id, chunk)
+            except (BadRequest, Forbidden) as e:
+                # Too old, already gone or no permission - retrying will not help
+                logger.warning(f"Could not delete user's file messages in chat {chat_id}: {e}")
+            except TelegramError as e:
+                given_up = await self.repo.retry_pending_deletions_later(
+                    chat_id, chunk, self.retry_interval, self.max_attempts
+                )
+                logger.warning(f"Deleting messages in chat {chat_id} failed, will retry: {e}")
+                if given_up:
+                    logger.warning(f"Gave up deleting {given_up} messages in chat {chat_id}")
+                continue
+            await self.repo.remove_pending_deletions(chat_id, chunk)
@@ -0,0 +1,57 @@
+import os
+import sys
+import subprocess
+
+from webhook import worker_count
+
+# Production server settings, read by `gunicorn main:app`.
+#
+# Every worker runs its own copy of the bot on its own event loop and
+# processes the webhook requests gunicorn routes to it. The webhook view only
+# queues the update, so a few threads per worker keep up with Telegram, and
+# handlers run concurrently inside the worker (WEBHOOK_CONCURRENCY).
+#
+# One worker per core by default (WEB_CONCURRENCY overrides it). gunicorn
+# cannot route a chat to a fixed worker, so state a later update needs (the
+# /search query, the multi-select selection) is kept in the database. Open
+# upload batches and per-chat update ordering stay per worker; see README.
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = worker_count()
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+timeout = 120
+# Time a stopping worker gets to flush its bot (see worker_exit and SHUTDOWN_TIMEOUT)
+graceful_timeout = 30
+# Workers must import the app themselves; database pools and the bot's event
+# loop thread do not survive a fork
+preload_app = False
+
+
+def when_ready(server):
+    """Register the webhook once, alongside the workers starting up.
+
+    The allowed update types come from the bot's handlers, which only exist
+    once the app is imported. The master must not import it (see
+    preload_app), so the registration runs as a separate `flask` command.
+    It is not waited for: the master starts the workers right away, and
+    reaps the command like any other child when it exits.
+    """
+    from webhook import webhook_enabled
+
+    if os.environ.get("BOT_TOKEN") and webhook_enabled():
+        subprocess.Popen([sys.executable, "-m", "flask", "--app", "main", "set-webhook"])
+
+
+def post_worker_init(worker):
+    """Start schema checks and the bot in the background; the worker serves health checks meanwhile"""
+    import main
+
+    main.start_background_init()
+
+
+def worker_exit(server, worker):
+    """Stop the worker's bot so updates it acknowledged, open upload batches and queued deletions are flushed"""
+    main = sys.modules.get("main")
+    if main is not None:
+        main.stop_webhook_runtime()
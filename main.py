@@ -1,15 +1,18 @@
 import os
+import hmac
+import time
 import asyncio
 import logging
-from threading import Thread
+from collections import namedtuple
+from threading import Event, Lock, Thread
 
-from flask import Flask, request
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import DeclarativeBase
-from telegram.ext import Application
-from telegram import Update
+from flask import Blueprint, Flask, request
 from dotenv import load_dotenv
 
+# python-telegram-bot and the bot modules are imported where they are first
+# used, so the web process can answer health checks before loading them
+from webhook import api_base_urls, register_webhook, webhook_enabled, webhook_secret
+
 # Load environment variables
 load_dotenv()
 
@@ -24,45 +27,111 @@ logger = logging.getLogger(__name__)
 # Import db from models to avoid circular import
 from models import db
 
-# Create the Flask app
-app = Flask(__name__)
-app.secret_key = os.environ.get("FLASK_SECRET_KEY", "a-secret-key-for-telegram-bot")
-
-# Configure the database - prioritize Neon database for production
-database_url = os.environ.get("NEON_DATABASE_URL") or os.environ.get("DATABASE_URL")
-if not database_url:
-    logger.error("No database URL found. Please set NEON_DATABASE_URL or DATABASE_URL environment variable.")
-    exit(1)
-
-# Clean the database URL if it contains psql command syntax
-if database_url.startswith("psql"):
-    # Extract the actual URL from psql command
-    import re
-    match = re.search(r"'(postgresql://[^']+)'", database_url)
-    if match:
-        database_url = match.group(1)
-    else:
-        logger.error("Could not extract database URL from psql command")
+# HTTP endpoints, registered on the app by create_app()
+web = Blueprint("web", __name__)
+
+# This process's bot Application, the event loop it runs on and the update ids
+# it has already accepted (webhook mode)
+WebhookRuntime = namedtuple("WebhookRuntime", ["application", "loop", "seen_updates"])
+_webhook_runtime = None
+_webhook_runtime_lock = Lock()
+
+# Background startup: schema checks, then (in webhook mode) the bot
+_startup_thread = None
+_startup_lock = Lock()
+_startup_done = Event()
+_startup_error = None
+_startup_failed_at = None
+
+# A failed startup (e.g. Telegram unreachable) is tried again on the next
+# request after this many seconds; until then webhook requests get a 503
+STARTUP_RETRY_INTERVAL = float(os.environ.get("STARTUP_RETRY_INTERVAL", 30))
+
+# How long a stopping worker waits for its bot to finish queued updates,
+# upload batches and message deletions; keep it under gunicorn's graceful_timeout
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", 20))
+
+# How long a webhook request waits for startup before asking Telegram to retry.
+# Kept short: a waiting request holds one of the worker's few threads, and at
+# cold start Telegram opens up to WEBHOOK_MAX_CONNECTIONS requests at once,
+# which would leave none for /health
+STARTUP_WAIT_TIMEOUT = float(os.environ.get("STARTUP_WAIT_TIMEOUT", 1))
+
+
+def get_database_url():
+    """Read the database URL from the environment, exiting if there is none"""
+    # Prioritize Neon database for production
+    database_url = os.environ.get("NEON_DATABASE_URL") or os.environ.get("DATABASE_URL")
+    if not database_url:
+        logger.error("No database URL found. Please set NEON_DATABASE_URL or DATABASE_URL environment variable.")
         exit(1)
 
-logger.info(f"Using database URL: {database_url[:30]}...")  # Log first 30 chars for debugging
-app.config["SQLALCHEMY_DATABASE_URI"] = database_url
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
+    # Clean the database URL if it contains psql command syntax
+    if database_url.startswith("psql"):
+        # Extract the actual URL from psql command
+        import re
+        match = re.search(r"'(postgresql://[^']+)'", database_url)
+        if match:
+            database_url = match.group(1)
+        else:
+            logger.error("Could not extract database URL from psql command")
+            exit(1)
+    return database_url
 
-# Initialize the app with the extension
-db.init_app(app)
 
-# Import models and bot handlers
-with app.app_context():
-    import models  # noqa: F401
-    from bot_handlers import setup_bot_handlers
-    db.create_all()
+def create_app():
+    """Create the Flask app: database, CLI commands and routes.
+
+    Does no database or network I/O, so the app can serve health checks right
+    away; schema checks and the bot run in start_background_init().
+    """
+    flask_app = Flask(__name__)
+    flask_app.secret_key = os.environ.get("FLASK_SECRET_KEY", "a-secret-key-for-telegram-bot")
+
+    database_url = get_database_url()
+    logger.info(f"Using database URL: {database_url[:30]}...")  # Log first 30 chars for debugging
+    flask_app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    flask_app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_recycle": 300,
+        "pool_pre_ping": True,
+    }
+
+    # Initialize the app with the extension
+    db.init_app(flask_app)
+
+    # Count and time every query for /metrics
+    with flask_app.app_context():
+        from metrics import instrument_engine
+        instrument_engine(db.engine)
+
+    @flask_app.cli.command("migrate")
+    def migrate_command():
+        """Apply pending schema migrations"""
+        from migrations import upgrade
+        applied = upgrade(db)
+        logger.info(f"Applied migrations: {applied or 'none pending'}")
+
+    @flask_app.cli.command("backfill-stats")
+    def backfill_stats_command():
+        """Rebuild the per-user storage totals from the stored files"""
+        from repository import backfill_user_stats
+        users = backfill_user_stats(db)
+        logger.info(f"Backfilled storage stats for {users} users")
+
+    @flask_app.cli.command("set-webhook")
+    def set_webhook_command():
+        """Register the webhook for the update types the bot's handlers consume"""
+        bot_token = os.environ.get("BOT_TOKEN")
+        if not bot_token or not webhook_enabled():
+            logger.error("set-webhook needs BOT_TOKEN and RENDER or WEBHOOK_URL")
+            return
+        register_webhook(bot_token, registered_update_types(bot_token, flask_app))
+
+    flask_app.register_blueprint(web)
+    return flask_app
 
 
-@app.route('/')
+@web.route('/')
 def health_check():
     """Health check endpoint for Render"""
     return {
@@ -72,19 +141,19 @@ def health_check():
     }
 
 
-@app.route('/health')
+@web.route('/health')
 def health():
-    """Additional health endpoint"""
-    return {"status": "healthy"}
+    """Additional health endpoint; answers while startup is still running in the background"""
+    return {"status": "healthy", "ready": _startup_done.is_set() and _startup_error is None}
 
 
-@app.route('/favicon.ico')
+@web.route('/favicon.ico')
 def favicon():
     """Favicon endpoint to prevent 404 errors"""
     return "", 204
 
 
-@app.route('/debug')
+@web.route('/debug')
 def debug():
     """Debug endpoint to check environment variables (for troubleshooting)"""
     return {
@@ -96,6 +165,153 @@ def debug():
     }
 
 
+@web.route('/metrics')
+def metrics():
+    """Prometheus metrics for this process"""
+    from metrics import REGISTRY
+    return REGISTRY.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+@web.route('/webhook/<token>', methods=['POST'])
+def webhook(token):
+    """Validate the update and hand it to the bot loop without waiting for handlers"""
+    bot_token = os.environ.get("BOT_TOKEN")
+    if not bot_token or not webhook_enabled() or not hmac.compare_digest(token, bot_token):
+        return 'Not Found', 404
+    # Telegram sends the secret registered with setWebhook; reject anything
+    # else before reading the body
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, webhook_secret(bot_token)):
+        return 'Forbidden', 403
+
+    if not wait_until_ready(STARTUP_WAIT_TIMEOUT):
+        # Telegram redelivers the update once we answer successfully
+        return 'Starting', 503
+
+    from telegram import Update
+    runtime = get_webhook_runtime()
+    if not runtime.application.running:
+        # Shutting down; an update queued now would never be processed
+        return 'Unavailable', 503
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+        return 'Bad Request', 400
+    if not runtime.seen_updates.claim(data["update_id"]):
+        # Telegram is redelivering an update we already accepted
+        return 'OK'
+    try:
+        update = Update.de_json(data, runtime.application.bot)
+    except Exception as e:
+        logger.error(f"Webhook error: {e}")
+        return 'Bad Request', 400
+    # Handler errors never reach Telegram: the update is retried or
+    # dead-lettered by the bot's error handler (see updates.UpdateRetry)
+    runtime.loop.call_soon_threadsafe(runtime.application.update_queue.put_nowait, update)
+    return 'OK'
+
+
+def start_background_init(flask_app=None):
+    """Create tables, apply migrations and, in webhook mode, start the bot on a background thread.
+
+    Idempotent; gunicorn calls it once per worker (see gunicorn.conf.py). After
+    a failure, a call made STARTUP_RETRY_INTERVAL seconds later starts again.
+    """
+    global _startup_thread, _startup_error
+    flask_app = flask_app or app
+    with _startup_lock:
+        retry = (
+            _startup_done.is_set() and _startup_error is not None
+            and time.monotonic() - _startup_failed_at >= STARTUP_RETRY_INTERVAL
+        )
+        if retry:
+            logger.info("Retrying startup after the previous attempt failed")
+            _startup_done.clear()
+            _startup_error = None
+        if _startup_thread is None or retry:
+            _startup_thread = Thread(target=_initialize, args=(flask_app,), name="startup", daemon=True)
+            _startup_thread.start()
+
+
+def wait_until_ready(timeout=None):
+    """Start background initialization if needed and wait for it; False if it failed or timed out"""
+    start_background_init()
+    return _startup_done.wait(timeout) and _startup_error is None
+
+
+def _initialize(flask_app):
+    global _startup_error, _startup_failed_at
+    started = time.perf_counter()
+    try:
+        # Concurrent workers wait on the migration lock
+        with flask_app.app_context():
+            from migrations import upgrade
+            upgrade(db)
+        if webhook_enabled() and os.environ.get("BOT_TOKEN"):
+            get_webhook_runtime()
+        logger.info(f"Startup finished in {time.perf_counter() - started:.2f}s")
+    except Exception as e:
+        _startup_failed_at = time.monotonic()
+        _startup_error = e
+        logger.error(f"Startup failed: {e}")
+    finally:
+        _startup_done.set()
+
+
+def get_webhook_runtime():
+    """Return this process's bot Application and loop, starting them on first use.
+
+    Each gunicorn worker runs its own Application and processes the webhook
+    requests gunicorn routes to it. State that a later update may need is
+    kept in the database, since that update can reach another worker; open
+    upload batches and per-chat ordering only cover this worker's updates.
+    """
+    global _webhook_runtime
+    with _webhook_runtime_lock:
+        if _webhook_runtime is None:
+            from updates import ChatOrderedUpdateProcessor, build_seen_updates
+            concurrency = int(os.environ.get("WEBHOOK_CONCURRENCY", 8))
+            application = build_application(
+                os.environ["BOT_TOKEN"], concurrent_updates=ChatOrderedUpdateProcessor(concurrency)
+            )
+            loop = start_application_loop(application)
+            _webhook_runtime = WebhookRuntime(application, loop, build_seen_updates(db))
+            from metrics import register_cache
+            register_cache("seen_updates", _webhook_runtime.seen_updates.local)
+            logger.info(f"Bot started for webhook mode in process {os.getpid()} (concurrency={concurrency})")
+        return _webhook_runtime
+
+
+def stop_webhook_runtime(timeout=None):
+    """Stop this process's bot Application if it is running.
+
+    Called from gunicorn's worker_exit hook. Updates already accepted are
+    processed, then post_stop flushes open upload batches and queued message
+    deletions, and the Application is shut down and its loop stopped.
+    """
+    runtime = _webhook_runtime
+    if runtime is None or not runtime.application.running:
+        return
+    application, loop = runtime.application, runtime.loop
+
+    async def shutdown():
+        # The webhook answers 503 from here on, so Telegram keeps new updates
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+    started = time.perf_counter()
+    try:
+        asyncio.run_coroutine_threadsafe(shutdown(), loop).result(timeout or SHUTDOWN_TIMEOUT)
+        logger.info(f"Bot stopped in process {os.getpid()} in {time.perf_counter() - started:.2f}s")
+    except Exception as e:
+        logger.error(f"Error stopping the bot: {e!r}")
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+
+
 def run_bot():
     """Run the Telegram bot"""
     try:
@@ -106,12 +322,10 @@ def run_bot():
 
         logger.info(f"Bot token found: {bot_token[:10]}..." if bot_token else "No token")
         
-        # Create application
-        application = Application.builder().token(bot_token).build()
-        
-        # Setup bot handlers
-        with app.app_context():
-            setup_bot_handlers(application, db, app)
+        # Create application with handlers attached; updates from different
+        # chats run concurrently, each chat's in order (see updates.py)
+        from updates import ChatOrderedUpdateProcessor
+        application = build_application(bot_token, concurrent_updates=ChatOrderedUpdateProcessor())
         
         # Start the bot with proper async handling
         logger.info("Starting Telegram bot polling...")
@@ -124,8 +338,10 @@ def run_bot():
             loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
         
-        # Start polling
-        application.run_polling(drop_pending_updates=True)
+        # Start polling; updates sent while the bot was down are processed
+        # too, at the processor's backlog rate
+        from bot_handlers import allowed_updates
+        application.run_polling(drop_pending_updates=False, allowed_updates=allowed_updates(application))
         
     except Exception as e:
         logger.error(f"Error starting bot: {str(e)}")
@@ -134,89 +350,116 @@ def run_bot():
 
 
 def run_flask():
-    """Run the Flask app"""
+    """Run the Flask development server (production uses gunicorn, see gunicorn.conf.py)"""
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port, debug=False)
 
 
-async def setup_webhook():
-    """Set up webhook for production deployment"""
-    try:
-        bot_token = os.environ.get("BOT_TOKEN")
-        if not bot_token:
-            logger.error("BOT_TOKEN not found for webhook setup")
-            return None
-            
-        application = Application.builder().token(bot_token).build()
-        
-        with app.app_context():
-            setup_bot_handlers(application, db, app)
-        
-        # Get the webhook URL from environment or construct it
-        webhook_url = os.environ.get("WEBHOOK_URL")
-        if not webhook_url:
-            # Construct from Render service URL
-            service_url = os.environ.get("RENDER_EXTERNAL_URL", "https://your-service.onrender.com")
-            webhook_url = f"{service_url}/webhook/{bot_token}"
-        
-        logger.info(f"Setting webhook URL: {webhook_url}")
-        await application.bot.set_webhook(url=webhook_url)
-        
-        return application
-        
-    except Exception as e:
-        logger.error(f"Error setting up webhook: {e}")
-        return None
+def build_application(bot_token, concurrent_updates=False, flask_app=None):
+    """Build the Telegram Application with the bot handlers attached"""
+    from telegram.ext import Application
+
+    from bot_handlers import setup_bot_handlers
+    from outbound import OutboundScheduler
+
+    flask_app = flask_app or app
+    builder = (
+        Application.builder()
+        .token(bot_token)
+        .concurrent_updates(concurrent_updates)
+        .rate_limiter(OutboundScheduler())
+    )
+    urls = api_base_urls()
+    if urls:
+        builder = builder.base_url(urls["base_url"]).base_file_url(urls["base_file_url"])
+    application = builder.build()
+    with flask_app.app_context():
+        setup_bot_handlers(application, db, flask_app)
+    return application
+
+
+def registered_update_types(bot_token, flask_app=None):
+    """Update types the bot's handlers consume, read from a freshly built Application"""
+    from bot_handlers import allowed_updates
+    return allowed_updates(build_application(bot_token, flask_app=flask_app))
+
+
+def start_application_loop(application):
+    """Run the Application on a dedicated long-lived event loop in a background thread.
+
+    The loop initializes and starts the Application once, then keeps consuming
+    ``application.update_queue`` until the process exits. Returns the loop so
+    other threads can hand updates to it; if the Application fails to start,
+    the loop is closed and the error is raised here.
+    """
+    loop = asyncio.new_event_loop()
+    ready = Event()
+    failure = []
+
+    def run_loop():
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(application.initialize())
+            if application.post_init:
+                loop.run_until_complete(application.post_init(application))
+            loop.run_until_complete(application.start())
+        except Exception as e:
+            logger.error(f"Error starting bot application: {e}")
+            failure.append(e)
+            try:
+                loop.run_until_complete(application.shutdown())
+            except Exception as shutdown_error:
+                logger.warning(f"Error cleaning up after failed start: {shutdown_error}")
+            loop.close()
+            return
+        finally:
+            ready.set()
+        loop.run_forever()
+
+    Thread(target=run_loop, name="telegram-bot-loop", daemon=True).start()
+    ready.wait()
+    if failure:
+        raise failure[0]
+    return loop
+
+
+# Module-level app for `gunicorn main:app` and `flask --app main`
+app = create_app()
 
 
 if __name__ == "__main__":
     # Check if we're running on Render (production)
-    if os.environ.get("RENDER"):
-        # On Render, use webhook mode with Flask
-        logger.info("Running on Render - Flask app with webhook mode")
-        
+    if webhook_enabled():
+        # Webhook mode on the development server; production runs
+        # `gunicorn main:app` instead (see Procfile)
+        logger.info("Running in webhook mode on the Flask development server")
+
         # Debug environment variables
         logger.info(f"RENDER env: {os.environ.get('RENDER')}")
         logger.info(f"PORT env: {os.environ.get('PORT')}")
         logger.info(f"BOT_TOKEN set: {bool(os.environ.get('BOT_TOKEN'))}")
         logger.info(f"DATABASE_URL set: {bool(os.environ.get('DATABASE_URL'))}")
-        
-        # Set up bot for webhook mode
+
         bot_token = os.environ.get("BOT_TOKEN")
         if bot_token:
-            application = Application.builder().token(bot_token).build()
-            with app.app_context():
-                setup_bot_handlers(application, db, app)
-            
-            # Add webhook endpoint
-            @app.route(f'/webhook/{bot_token}', methods=['POST'])
-            def webhook():
-                """Handle webhook updates from Telegram"""
-                try:
-                    update = Update.de_json(request.get_json(force=True), application.bot)
-                    # Process update asynchronously
-                    import asyncio
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                    loop.run_until_complete(application.process_update(update))
-                    loop.close()
-                    return 'OK'
-                except Exception as e:
-                    logger.error(f"Webhook error: {e}")
-                    return 'Error', 500
-            
-            logger.info("Bot configured for webhook mode")
-        
+            # Building the handlers and calling Telegram must not hold up opening the port
+            Thread(
+                target=lambda: register_webhook(bot_token, registered_update_types(bot_token)),
+                name="webhook-registration", daemon=True
+            ).start()
+        start_background_init()
+
         # Run Flask app (this opens the required port for Render)
         logger.info("Starting Flask app...")
         run_flask()
     else:
         # Local development - run both
         logger.info("Running locally - starting both Flask and Telegram bot")
-        
+
         # Start Flask in a separate thread
         flask_thread = Thread(target=run_flask, daemon=True)
         flask_thread.start()
-        
-        # Run bot in main thread
-        run_bot()
+
+        # Run bot in main thread once the schema is in place
+        if wait_until_ready():
+            run_bot()
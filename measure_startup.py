@@ -0,0 +1,81 @@
+"""Measure how fast a fresh web process comes up.
+
+Each run starts a new interpreter that imports ``main`` and reports:
+
+- health: seconds until ``/health`` answers
+- ready:  seconds until background startup (migrations and, in webhook
+  mode, the bot) has finished
+
+The slowest imports of ``main`` are listed as well, so a new heavy import
+on the startup path shows up in review.
+
+Usage: python measure_startup.py [--runs 5] [--imports 10]
+Run it with the same environment as the app (DATABASE_URL, BOT_TOKEN, ...).
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+PROBE = """
+import json, time
+started = time.perf_counter()
+import main
+response = main.app.test_client().get("/health")
+assert response.status_code == 200, response.status_code
+health = time.perf_counter() - started
+ready = main.wait_until_ready()
+print(json.dumps({"health": health, "ready": time.perf_counter() - started, "ok": ready}))
+"""
+
+
+def run_probe():
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else "probe failed")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(limit):
+    """Top-level packages imported by ``main``, by cumulative import time in seconds"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Direct imports of main are indented by exactly three spaces
+        if name.startswith("    ") or not name.startswith("   "):
+            continue
+        imports.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(imports, reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--imports", type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [run_probe() for _ in range(args.runs)]
+    for key in ("health", "ready"):
+        values = [run[key] for run in runs]
+        print(f"{key:>7}: median {statistics.median(values):.3f}s  min {min(values):.3f}s  max {max(values):.3f}s")
+    if not all(run["ok"] for run in runs):
+        print("warning: background startup failed in some runs, see the app logs")
+
+    print("\nslowest imports of main:")
+    for seconds, name in slowest_imports(args.imports):
+        print(f"  {seconds:.3f}s  {name}")
+
+
+if __name__ == "__main__":
+    main()
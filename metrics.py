@@ -0,0 +1,263 @@
+import time
+import logging
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from a cached lookup up to a slow upload
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# SQL statement kinds tracked separately; anything else is counted as OTHER
+QUERY_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH"}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonic count, optionally split by labels"""
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    """Distribution of observed values (e.g. latencies) over fixed buckets"""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._values = {}
+        self._lock = Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket", labels + (("le", _format_value(bound)),), cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+class CallbackMetric:
+    """Values read from callbacks at scrape time, one per label set.
+
+    A gauge for current values such as a queue length, or a counter for
+    totals another object keeps, such as a cache's hit count.
+    """
+
+    def __init__(self, name, documentation, type="gauge", labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.type = type
+        self.labelnames = tuple(labelnames)
+        self._callbacks = {}
+        self._lock = Lock()
+
+    def set_callback(self, callback, **labels):
+        """Read the value for ``labels`` from ``callback()``, replacing any earlier callback"""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._callbacks[key] = callback
+
+    def samples(self):
+        with self._lock:
+            callbacks = list(self._callbacks.items())
+        for key, callback in callbacks:
+            try:
+                value = callback()
+            except Exception as e:
+                logger.warning(f"Could not read {self.name}: {e}")
+                continue
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+
+class Registry:
+    """Collects metrics and renders them in the Prometheus text format.
+
+    Metrics live in process memory, so with several gunicorn workers each
+    scrape of /metrics shows the worker that happened to serve it.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            # Registering a name again returns the existing metric, so setup code may run twice
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, callback):
+        """Expose ``callback()`` as a gauge; a later call for the same name replaces the callback"""
+        self.callback_metric(name, documentation).set_callback(callback)
+
+    def callback_metric(self, name, documentation, type="gauge", labelnames=()):
+        return self._register(CallbackMetric(name, documentation, type, labelnames))
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+UPDATES = REGISTRY.counter(
+    "bot_updates_total", "Telegram updates received, by kind", ["kind"]
+)
+HANDLER_DURATION = REGISTRY.histogram(
+    "bot_handler_duration_seconds", "Time spent in each bot handler", ["handler"]
+)
+HANDLER_ERRORS = REGISTRY.counter(
+    "bot_handler_errors_total", "Exceptions raised out of bot handlers", ["handler"]
+)
+UPDATE_DUPLICATES = REGISTRY.counter(
+    "bot_updates_duplicate_total", "Webhook redeliveries of updates already accepted"
+)
+UPDATE_RETRIES = REGISTRY.counter(
+    "bot_update_retries_total", "Updates queued again after a handler raised"
+)
+UPDATES_DEAD_LETTERED = REGISTRY.counter(
+    "bot_updates_dead_lettered_total", "Updates given up on and stored in failed_updates"
+)
+SCREENS_RENDERED = REGISTRY.counter(
+    "bot_screens_rendered_total", "Screens shown, by how: send, edit, edit_markup or unchanged (no API call)", ["action"]
+)
+PAGE_CACHE_LOOKUPS = REGISTRY.counter(
+    "bot_page_cache_lookups_total", "Rendered /myfiles page lookups, by result: hit or miss", ["result"]
+)
+CACHE_HITS = REGISTRY.callback_metric(
+    "bot_cache_hits_total", "In-process cache lookups that found an entry, by cache", "counter", ["cache"]
+)
+CACHE_MISSES = REGISTRY.callback_metric(
+    "bot_cache_misses_total", "In-process cache lookups that found nothing or an expired entry, by cache", "counter", ["cache"]
+)
+CACHE_EVICTIONS = REGISTRY.callback_metric(
+    "bot_cache_evictions_total", "Entries dropped to stay within a cache's size limit, by cache", "counter", ["cache"]
+)
+CACHE_ENTRIES = REGISTRY.callback_metric(
+    "bot_cache_entries", "Entries currently held, by cache", "gauge", ["cache"]
+)
+CACHE_SHARED_HITS = REGISTRY.callback_metric(
+    "bot_cache_shared_hits_total", "Local misses answered by the shared (Redis) cache, by cache", "counter", ["cache"]
+)
+DB_QUERIES = REGISTRY.counter(
+    "db_queries_total", "SQL statements executed, by operation", ["operation"]
+)
+DB_QUERY_DURATION = REGISTRY.histogram(
+    "db_query_duration_seconds", "SQL statement execution time", ["operation"]
+)
+DB_QUERY_ERRORS = REGISTRY.counter(
+    "db_query_errors_total", "SQL statements that raised an error", ["operation"]
+)
+TELEGRAM_CALL_DURATION = REGISTRY.histogram(
+    "telegram_api_duration_seconds", "Bot API call latency, excluding time queued by the scheduler", ["endpoint"]
+)
+TELEGRAM_CALL_ERRORS = REGISTRY.counter(
+    "telegram_api_errors_total", "Bot API calls that raised an error", ["endpoint", "error"]
+)
+TELEGRAM_RETRY_AFTER = REGISTRY.counter(
+    "telegram_api_retry_after_total", "RetryAfter (flood control) responses from Telegram", ["endpoint"]
+)
+
+
+def register_cache(name, cache):
+    """Export the counters of ``cache.stats()`` (see cache.LRUCache) labelled ``cache=name``"""
+    CACHE_HITS.set_callback(lambda: cache.stats()["hits"], cache=name)
+    CACHE_MISSES.set_callback(lambda: cache.stats()["misses"], cache=name)
+    CACHE_EVICTIONS.set_callback(lambda: cache.stats()["evictions"], cache=name)
+    CACHE_ENTRIES.set_callback(lambda: cache.stats()["entries"], cache=name)
+    if "backend_hits" in cache.stats():
+        CACHE_SHARED_HITS.set_callback(lambda: cache.stats()["backend_hits"], cache=name)
+
+
+def query_operation(statement):
+    words = statement.lstrip().split(None, 1)
+    operation = words[0].upper() if words else ""
+    return operation if operation in QUERY_OPERATIONS else "OTHER"
+
+
+def instrument_engine(engine):
+    """Count and time every SQL statement run through ``engine``"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        operation = query_operation(statement)
+        DB_QUERIES.inc(operation=operation)
+        DB_QUERY_DURATION.observe(time.perf_counter() - started, operation=operation)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        started = exception_context.connection.info.get("query_started") if exception_context.connection else None
+        if started:
+            started.pop()
+        operation = query_operation(exception_context.statement or "")
+        DB_QUERIES.inc(operation=operation)
+        DB_QUERY_ERRORS.inc(operation=operation)
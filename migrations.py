@@ -0,0 +1,161 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import inspect, insert, select, text
+from sqlalchemy.exc import DBAPIError
+
+from models import FileBlob, FileMetadata, SchemaMigration, file_listing_index, file_ownership_index
+
+logger = logging.getLogger(__name__)
+
+# Key for the Postgres advisory lock that keeps concurrent starts from racing
+MIGRATION_LOCK_ID = 7305001
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register a schema change; pending versions are applied in ascending order"""
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return register
+
+
+def upgrade(db):
+    """Create missing tables and apply pending migrations to the configured database.
+
+    ``create_all()`` creates missing tables but never alters existing ones, so
+    every change to an existing table (new indexes, columns, constraints) is
+    listed here. Each migration must work both on a schema that create_all just
+    built and on an older deployed one. Returns the versions applied.
+    """
+    engine = db.engine
+    applied_now = []
+
+    with engine.connect() as conn:
+        is_postgres = engine.dialect.name == "postgresql"
+        if is_postgres:
+            conn.execute(text("SELECT pg_advisory_lock(:lock_id)"), {"lock_id": MIGRATION_LOCK_ID})
+            conn.commit()
+        try:
+            # Workers starting together must not race on CREATE TABLE either
+            db.metadata.create_all(bind=conn)
+            conn.commit()
+            applied = set(conn.execute(select(SchemaMigration.version)).scalars())
+            for version, description, func in sorted(MIGRATIONS, key=lambda m: m[0]):
+                if version in applied:
+                    continue
+                logger.info(f"Applying migration {version}: {description}")
+                func(conn)
+                conn.execute(insert(SchemaMigration).values(
+                    version=version,
+                    description=description,
+                    applied_at=datetime.utcnow()
+                ))
+                conn.commit()
+                applied_now.append(version)
+        finally:
+            conn.rollback()
+            if is_postgres:
+                conn.execute(text("SELECT pg_advisory_unlock(:lock_id)"), {"lock_id": MIGRATION_LOCK_ID})
+                conn.commit()
+
+    return applied_now
+
+
+def has_column(conn, table, column):
+    """Whether ``table`` already has ``column`` (e.g. because create_all just built it)"""
+    return any(c["name"] == column for c in inspect(conn).get_columns(table))
+
+
+def rebuild_sqlite_table(conn, table):
+    """Recreate ``table`` from its model and copy the rows, since SQLite cannot drop constraints"""
+    columns = ", ".join(column.name for column in table.c)
+    for index in inspect(conn).get_indexes(table.name):
+        conn.execute(text(f'DROP INDEX IF EXISTS "{index["name"]}"'))
+    conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {table.name}_old"))
+    table.create(bind=conn)
+    conn.execute(text(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {table.name}_old"))
+    conn.execute(text(f"DROP TABLE {table.name}_old"))
+
+
+@migration(1, "Composite (user_id, upload_date DESC, id) index for the file listing")
+def add_file_listing_index(conn):
+    file_listing_index.create(bind=conn, checkfirst=True)
+    # The composite index starts with user_id, so the single-column one is redundant
+    conn.execute(text("DROP INDEX IF EXISTS ix_file_metadata_user_id"))
+
+
+@migration(2, "Record the Telegram media kind of each file")
+def add_media_kind(conn):
+    if not has_column(conn, "file_metadata", "media_kind"):
+        conn.execute(text(
+            "ALTER TABLE file_metadata ADD COLUMN media_kind VARCHAR(20) NOT NULL DEFAULT 'document'"
+        ))
+    # A file_id starts with its base64-encoded type tag, which tells the kind of
+    # every existing row without asking Telegram
+    conn.execute(text("""
+        UPDATE file_metadata SET media_kind = CASE
+            WHEN file_id LIKE 'AgAC%' THEN 'photo'
+            WHEN file_id LIKE 'BAAC%' THEN 'video'
+            WHEN file_id LIKE 'CQAC%' THEN 'audio'
+            WHEN file_id LIKE 'AwAC%' THEN 'voice'
+            WHEN file_id LIKE 'DQAC%' THEN 'video_note'
+            ELSE 'document'
+        END
+        WHERE media_kind = 'document'
+    """))
+
+
+@migration(3, "Trigram indexes for searching filenames and MIME types")
+def add_search_indexes(conn):
+    if conn.dialect.name != "postgresql":
+        # Other databases are searched through search.MemorySearchIndex
+        return
+    try:
+        with conn.begin_nested():
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except DBAPIError as e:
+        logger.warning(f"pg_trgm is unavailable, /search will scan each user's files instead: {e}")
+        return
+    # GIN trigram indexes serve the ILIKE '%query%' filters of FileRepository.search_files_page
+    for column in ("filename", "mime_type"):
+        conn.execute(text(
+            f"CREATE INDEX IF NOT EXISTS ix_file_metadata_{column}_trgm "
+            f"ON file_metadata USING gin ({column} gin_trgm_ops)"
+        ))
+
+
+@migration(4, "Shared file blobs keyed on file_unique_id; files unique per user instead of per file_id")
+def add_file_blobs(conn):
+    FileBlob.__table__.create(bind=conn, checkfirst=True)
+    if not has_column(conn, "file_metadata", "blob_id"):
+        conn.execute(text("ALTER TABLE file_metadata ADD COLUMN blob_id INTEGER REFERENCES file_blobs (id)"))
+    # Files stored before file_unique_id was recorded get a blob of their own,
+    # keyed on their file_id (globally unique until now)
+    conn.execute(text("""
+        INSERT INTO file_blobs (file_unique_id, file_id, file_size, mime_type, media_kind, created_at)
+        SELECT file_id, file_id, file_size, mime_type, media_kind, upload_date
+        FROM file_metadata WHERE blob_id IS NULL
+    """))
+    conn.execute(text("""
+        UPDATE file_metadata SET blob_id = (
+            SELECT file_blobs.id FROM file_blobs WHERE file_blobs.file_unique_id = file_metadata.file_id
+        )
+        WHERE blob_id IS NULL
+    """))
+
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("ALTER TABLE file_metadata ALTER COLUMN blob_id SET NOT NULL"))
+        conn.execute(text("ALTER TABLE file_metadata DROP CONSTRAINT IF EXISTS file_metadata_file_id_key"))
+    elif conn.dialect.name == "sqlite":
+        unique_file_id = any(
+            constraint["column_names"] == ["file_id"]
+            for constraint in inspect(conn).get_unique_constraints("file_metadata")
+        )
+        if unique_file_id:
+            rebuild_sqlite_table(conn, FileMetadata.__table__)
+    else:
+        logger.warning("Drop the unique constraint on file_metadata.file_id by hand so users can share content")
+    file_ownership_index.create(bind=conn, checkfirst=True)
@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Integer, String, BigInteger, DateTime, Text
+from sqlalchemy import JSON, Integer, String, BigInteger, DateTime, Text, Index, ForeignKey
 from sqlalchemy.orm import Mapped, mapped_column
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
@@ -12,16 +12,35 @@ class Base(DeclarativeBase):
 db = SQLAlchemy(model_class=Base)
 
 
+class FileBlob(db.Model):
+    """Stored content, keyed on Telegram's file_unique_id and shared by every user who uploaded it"""
+    __tablename__ = 'file_blobs'
+    
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    file_unique_id: Mapped[str] = mapped_column(String(255), nullable=False, unique=True)
+    file_id: Mapped[str] = mapped_column(String(255), nullable=False)
+    file_size: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    mime_type: Mapped[str] = mapped_column(String(100), nullable=True)
+    media_kind: Mapped[str] = mapped_column(String(20), nullable=False, default='document')
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    
+    def __repr__(self):
+        return f'<FileBlob {self.file_unique_id}>'
+
+
 class FileMetadata(db.Model):
-    """Model for storing file metadata"""
+    """Model for storing file metadata: one user's entry for a FileBlob"""
     __tablename__ = 'file_metadata'
     
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    user_id: Mapped[int] = mapped_column(BigInteger, nullable=False, index=True)
-    file_id: Mapped[str] = mapped_column(String(255), nullable=False, unique=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    blob_id: Mapped[int] = mapped_column(Integer, ForeignKey('file_blobs.id'), nullable=False)
+    # Copies of the blob's columns, so listings and downloads need no join
+    file_id: Mapped[str] = mapped_column(String(255), nullable=False)
     filename: Mapped[str] = mapped_column(String(500), nullable=False)
     file_size: Mapped[int] = mapped_column(BigInteger, nullable=True)
     mime_type: Mapped[str] = mapped_column(String(100), nullable=True)
+    media_kind: Mapped[str] = mapped_column(String(20), nullable=False, default='document', server_default='document')
     upload_date: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
     
     def __repr__(self):
@@ -32,9 +51,94 @@ class FileMetadata(db.Model):
         return {
             'id': self.id,
             'user_id': self.user_id,
+            'blob_id': self.blob_id,
             'file_id': self.file_id,
             'filename': self.filename,
             'file_size': self.file_size,
             'mime_type': self.mime_type,
+            'media_kind': self.media_kind,
             'upload_date': self.upload_date.isoformat() if self.upload_date else None
         }
+
+
+# Serves the /myfiles listing: filter by user, newest first, with the columns the
+# listing needs included so Postgres can answer it from the index alone
+file_listing_index = Index(
+    'ix_file_metadata_user_upload',
+    FileMetadata.user_id,
+    FileMetadata.upload_date.desc(),
+    FileMetadata.id,
+    postgresql_include=['filename', 'mime_type', 'file_size']
+)
+
+# A user owns each piece of content at most once; uploads conflict on this index
+file_ownership_index = Index(
+    'uq_file_metadata_user_blob',
+    FileMetadata.user_id,
+    FileMetadata.blob_id,
+    unique=True
+)
+
+
+class UserStats(db.Model):
+    """Per-user storage totals, kept in step with FileMetadata writes"""
+    __tablename__ = 'user_stats'
+    
+    user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    file_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    total_bytes: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    last_upload: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<UserStats {self.user_id}: {self.file_count} files>'
+
+
+class UserState(db.Model):
+    """A user's /search query and /myfiles multi-select selection, shared by every worker"""
+    __tablename__ = 'user_states'
+    
+    user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    search_query: Mapped[str] = mapped_column(Text, nullable=True)
+    # Page token the selection was started on; NULL outside multi-select mode
+    selection_page: Mapped[str] = mapped_column(String(64), nullable=True)
+    selected_ids: Mapped[list] = mapped_column(JSON, nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class SchemaMigration(db.Model):
+    """Versions applied by migrations.upgrade()"""
+    __tablename__ = 'schema_migrations'
+    
+    version: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    description: Mapped[str] = mapped_column(String(255), nullable=False)
+    applied_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class PendingDeletion(db.Model):
+    """Uploaded messages waiting to be removed from their chat by the cleanup queue"""
+    __tablename__ = 'pending_deletions'
+    
+    chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    message_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+
+class ProcessedUpdate(db.Model):
+    """Telegram update ids accepted by a webhook worker, shared so redeliveries to any worker are skipped"""
+    __tablename__ = 'processed_updates'
+    
+    update_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    received_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+
+class FailedUpdate(db.Model):
+    """Updates whose handlers kept failing after every retry (the dead-letter table)"""
+    __tablename__ = 'failed_updates'
+    
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    update_id: Mapped[int] = mapped_column(BigInteger, nullable=False, index=True)
+    payload: Mapped[str] = mapped_column(Text, nullable=False)
+    error: Mapped[str] = mapped_column(Text, nullable=True)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False)
+    failed_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
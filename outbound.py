@@ -0,0 +1,215 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import TELEGRAM_CALL_DURATION, TELEGRAM_CALL_ERRORS, TELEGRAM_RETRY_AFTER
+
+logger = logging.getLogger(__name__)
+
+# Request priorities; lower values are served first when tokens are scarce
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Endpoints that only tidy up and can wait behind user-facing replies
+BACKGROUND_ENDPOINTS = {"deleteMessage", "deleteMessages"}
+
+
+class TokenBucket:
+    """Token bucket whose waiters are served in priority order.
+
+    Holds up to ``capacity`` tokens, refilled at ``rate`` tokens per second.
+    A request that finds no token waits in a heap ordered by (priority,
+    arrival), so background work never overtakes an interactive reply that
+    is already waiting.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._wakeup = None
+
+    @property
+    def waiting(self):
+        return sum(1 for *_, future in self._waiters if not future.done())
+
+    @property
+    def idle(self):
+        """Whether the bucket is full with nobody waiting, i.e. safe to forget"""
+        self._refill()
+        return not self._waiters and self.tokens >= self.capacity
+
+    async def acquire(self, cost=1, priority=INTERACTIVE):
+        cost = min(cost, self.capacity)
+        self._refill()
+        if not self._waiters and self.tokens >= cost:
+            self.tokens -= cost
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), cost, future))
+        self._grant()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The token was granted just as we were cancelled - hand it back
+                self.tokens += cost
+                self._grant()
+            raise
+
+    def pause(self, seconds):
+        """Withhold all tokens for ``seconds``, e.g. after a RetryAfter from Telegram"""
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+        self._grant()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _grant(self):
+        self._refill()
+        while self._waiters:
+            priority, sequence, cost, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if self.tokens < cost:
+                break
+            heapq.heappop(self._waiters)
+            self.tokens -= cost
+            future.set_result(None)
+
+        if self._waiters and self._wakeup is None:
+            cost = self._waiters[0][2]
+            delay = max((cost - self.tokens) / self.rate, 0.001)
+            self._wakeup = asyncio.get_running_loop().call_later(delay, self._on_wakeup)
+
+    def _on_wakeup(self):
+        self._wakeup = None
+        self._grant()
+
+
+class OutboundScheduler(BaseRateLimiter):
+    """Central scheduler for every outbound Bot API call.
+
+    Installed as the Application's rate limiter, so each ``reply_text``,
+    ``send_*``, ``edit_message_text`` and delete made through the bot passes
+    through it. Every call takes a token from the global bucket; calls
+    addressed to a chat (not e.g. answerCallbackQuery, answerInlineQuery or
+    inline message edits) first take one from that chat's bucket. Deletes are queued as background work behind
+    interactive replies. A RetryAfter from Telegram pauses the affected bucket
+    for the requested time and the call is retried up to ``max_retries`` times
+    before the error reaches the handler.
+
+    ``rate_limit_args`` may be a dict with ``priority`` and/or ``max_retries``
+    to override the defaults for a single call.
+    """
+
+    def __init__(self, global_rate=None, chat_rate=None, group_rate=None, max_retries=None, max_chats=10000):
+        self.global_rate = global_rate or float(os.environ.get("OUTBOUND_GLOBAL_RATE", 30))
+        self.chat_rate = chat_rate or float(os.environ.get("OUTBOUND_CHAT_RATE", 1))
+        self.group_rate = group_rate or float(os.environ.get("OUTBOUND_GROUP_RATE", 20 / 60))
+        self.max_retries = max_retries if max_retries is not None else int(os.environ.get("OUTBOUND_MAX_RETRIES", 3))
+        self.max_chats = max_chats
+        self._global = None
+        self._chats = OrderedDict()
+        self.calls = 0
+        self.retry_afters = 0
+        self.failures = 0
+
+    async def initialize(self):
+        # Buckets are created lazily; the first call sets up the loop-bound state
+        pass
+
+    async def shutdown(self):
+        self._chats.clear()
+
+    @property
+    def queue_depth(self):
+        """Calls currently waiting for a token"""
+        waiting = sum(bucket.waiting for bucket in self._chats.values())
+        if self._global is not None:
+            waiting += self._global.waiting
+        return waiting
+
+    def _global_bucket(self):
+        if self._global is None:
+            self._global = TokenBucket(self.global_rate, max(self.global_rate, 1))
+        return self._global
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Groups and channels (negative or @username ids) get Telegram's lower per-minute budget
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = TokenBucket(rate, 3)
+            self._chats[chat_id] = bucket
+            self._forget_idle_chats()
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _forget_idle_chats(self):
+        while len(self._chats) > self.max_chats:
+            chat_id, bucket = next(iter(self._chats.items()))
+            if not bucket.idle:
+                break
+            del self._chats[chat_id]
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        options = rate_limit_args or {}
+        priority = options.get("priority", BACKGROUND if endpoint in BACKGROUND_ENDPOINTS else INTERACTIVE)
+        max_retries = options.get("max_retries", self.max_retries)
+
+        chat_id = data.get("chat_id")
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        # An album counts as one message per item towards Telegram's limits
+        cost = len(data.get("media") or ()) or 1
+
+        for attempt in range(max_retries + 1):
+            chat_bucket = None
+            if chat_id is not None:
+                chat_bucket = self._chat_bucket(chat_id)
+                await chat_bucket.acquire(cost, priority)
+            await self._global_bucket().acquire(cost, priority)
+            self.calls += 1
+            started = time.perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retry_afters += 1
+                TELEGRAM_RETRY_AFTER.inc(endpoint=endpoint)
+                delay = e.retry_after
+                if isinstance(delay, timedelta):
+                    delay = delay.total_seconds()
+                if attempt == max_retries:
+                    self.failures += 1
+                    TELEGRAM_CALL_ERRORS.inc(endpoint=endpoint, error=type(e).__name__)
+                    logger.error(f"{endpoint} still rate limited after {max_retries} retries")
+                    raise
+                logger.info(f"{endpoint} hit Telegram's flood limit, retrying in {delay}s")
+                # The paused bucket holds the next attempt back
+                (chat_bucket or self._global_bucket()).pause(delay)
+            except Exception as e:
+                TELEGRAM_CALL_ERRORS.inc(endpoint=endpoint, error=type(e).__name__)
+                raise
+            finally:
+                TELEGRAM_CALL_DURATION.observe(time.perf_counter() - started, endpoint=endpoint)
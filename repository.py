@@ -0,0 +1,650 @@
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from datetime import datetime, timedelta
+from functools import partial
+from operator import attrgetter
+
+from sqlalchemy import delete, func, insert, or_, select, tuple_, update
+from sqlalchemy.exc import IntegrityError
+
+from models import FailedUpdate, FileBlob, FileMetadata, PendingDeletion, UserState, UserStats
+
+logger = logging.getLogger(__name__)
+
+# Columns read by the /myfiles listing; all of them live in ix_file_metadata_user_upload
+LISTING_COLUMNS = (
+    FileMetadata.id,
+    FileMetadata.filename,
+    FileMetadata.mime_type,
+    FileMetadata.file_size,
+    FileMetadata.upload_date,
+)
+
+# Detached, picklable copy of a FileMetadata row, as held by the file cache
+FileRecord = namedtuple("FileRecord", [column.name for column in FileMetadata.__table__.c])
+
+# One page of files plus whether neighbouring pages exist
+FilePage = namedtuple("FilePage", ["files", "has_newer", "has_older"])
+
+# A multi-select selection: the page token it started on and the chosen record ids
+Selection = namedtuple("Selection", ["page", "ids"])
+
+
+def blob_fields(upload):
+    """Columns of a FileBlob taken from an upload dict"""
+    return {key: upload[key] for key in ('file_id', 'file_size', 'mime_type', 'media_kind')}
+
+
+def entry_fields(upload):
+    """Columns of a user's FileMetadata entry taken from an upload dict"""
+    return {key: upload[key] for key in ('file_id', 'filename', 'file_size', 'mime_type', 'media_kind')}
+
+
+def dialect_insert(db):
+    """Return the dialect-specific ``insert`` construct with ON CONFLICT support, if any"""
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+        return insert
+    return None
+
+
+def backfill_user_stats(db):
+    """Rebuild every UserStats row from FileMetadata in a single transaction"""
+    totals = select(
+        FileMetadata.user_id,
+        func.count(FileMetadata.id),
+        func.coalesce(func.sum(FileMetadata.file_size), 0),
+        func.max(FileMetadata.upload_date)
+    ).group_by(FileMetadata.user_id)
+    db.session.execute(delete(UserStats))
+    result = db.session.execute(
+        insert(UserStats).from_select(
+            ['user_id', 'file_count', 'total_bytes', 'last_upload'], totals
+        )
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+class FileRepository:
+    """Async access to FileMetadata for the bot handlers.
+
+    Every query runs inside a Flask app context on a bounded thread pool, so a
+    slow Postgres round trip only occupies one worker thread instead of
+    stalling the event loop for every other user. Returned rows are detached
+    from the session and safe to read after the call completes.
+    """
+
+    def __init__(self, db, flask_app, max_workers=None, file_cache=None, search_index=None, page_cache=None):
+        self.db = db
+        self.flask_app = flask_app
+        self.file_cache = file_cache
+        self.search_index = search_index
+        self.page_cache = page_cache
+        if max_workers is None:
+            max_workers = int(os.environ.get("DB_EXECUTOR_WORKERS", 4))
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+
+    async def _run(self, func, *args, **kwargs):
+        """Run a blocking database function on the executor"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(self._call_in_context, func, *args, **kwargs))
+
+    def _call_in_context(self, func, *args, **kwargs):
+        with self.flask_app.app_context():
+            return func(*args, **kwargs)
+
+    def shutdown(self):
+        """Stop accepting new work and wait for running queries"""
+        self._executor.shutdown(wait=True)
+
+    # Blocking implementations
+
+    def _add_files(self, user_id, uploads):
+        self._adopt_legacy_blobs(uploads)
+        upsert = dialect_insert(self.db)
+        if upsert is None:
+            return [
+                self._add_file_select_first(user_id, **upload)
+                for upload in uploads
+            ]
+
+        session = self.db.session
+        uploaded_at = datetime.utcnow()
+        blob_ids = self._upsert_blobs(upsert, uploads, uploaded_at)
+
+        # The same content repeated within the batch is only stored once
+        entries = {}
+        for upload in uploads:
+            blob_id = blob_ids[upload['file_unique_id']]
+            if blob_id not in entries:
+                entries[blob_id] = dict(
+                    entry_fields(upload), user_id=user_id, blob_id=blob_id, upload_date=uploaded_at
+                )
+        stmt = (
+            upsert(FileMetadata)
+            .values(list(entries.values()))
+            .on_conflict_do_nothing(index_elements=[FileMetadata.user_id, FileMetadata.blob_id])
+            .returning(*FileMetadata.__table__.c)
+        )
+        if self.db.engine.dialect.name == "postgresql":
+            # Insert and bump the user's stats in one statement, i.e. one round trip
+            inserted = stmt.cte("inserted")
+            stats = self._stats_increment(upsert, inserted).cte("stats")
+            rows = session.execute(select(inserted).add_cte(stats)).all()
+        else:
+            rows = session.execute(stmt).all()
+            if rows:
+                self._update_user_stats(
+                    user_id, len(rows), sum(row.file_size or 0 for row in rows), uploaded_at
+                )
+        session.commit()
+
+        created = {row.blob_id: row for row in rows}
+        # ON CONFLICT skipped these inserts because the user already owns the
+        # content; read their existing entries
+        missing = [blob_id for blob_id in entries if blob_id not in created]
+        existing = {}
+        if missing:
+            existing = {
+                row.blob_id: row
+                for row in session.execute(
+                    select(*FileMetadata.__table__.c).where(
+                        FileMetadata.user_id == user_id,
+                        FileMetadata.blob_id.in_(missing)
+                    )
+                )
+            }
+
+        results = []
+        for upload in uploads:
+            blob_id = blob_ids[upload['file_unique_id']]
+            if blob_id in created:
+                results.append((created.pop(blob_id), True))
+                existing[blob_id] = results[-1][0]
+            else:
+                results.append((existing[blob_id], False))
+        return results
+
+    def _adopt_legacy_blobs(self, uploads):
+        """Give blobs created by migration 4 their real file_unique_id when their content comes back.
+
+        Files stored before file_unique_id was recorded got a blob keyed on
+        their file_id. If an upload's file_unique_id has no blob yet but its
+        file_id is such a key, that blob is re-keyed, so the upload matches
+        the copies users already have instead of being stored again.
+        """
+        unique_ids = {upload['file_unique_id'] for upload in uploads}
+        legacy_keys = {upload['file_id'] for upload in uploads} - unique_ids
+        session = self.db.session
+        known = set(session.scalars(
+            select(FileBlob.file_unique_id).where(FileBlob.file_unique_id.in_(unique_ids | legacy_keys))
+        ))
+        for upload in uploads:
+            unique_id, legacy_key = upload['file_unique_id'], upload['file_id']
+            if unique_id in known or legacy_key not in known:
+                continue
+            try:
+                with session.begin_nested():
+                    session.execute(
+                        update(FileBlob)
+                        .where(FileBlob.file_unique_id == legacy_key)
+                        .values(file_unique_id=unique_id)
+                    )
+            except IntegrityError:
+                # A concurrent upload created the blob for this content first
+                continue
+            known.discard(legacy_key)
+            known.add(unique_id)
+
+    def _upsert_blobs(self, upsert, uploads, seen_at):
+        """Insert or refresh the blob of every upload; returns ``{file_unique_id: blob id}``"""
+        blobs = {
+            upload['file_unique_id']: dict(
+                blob_fields(upload), file_unique_id=upload['file_unique_id'], created_at=seen_at
+            )
+            for upload in uploads
+        }
+        stmt = upsert(FileBlob).values(list(blobs.values()))
+        # DO UPDATE rather than DO NOTHING so RETURNING also yields existing blobs;
+        # it keeps the newest file_id, which is as good as any for sending
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[FileBlob.file_unique_id],
+            set_={'file_id': stmt.excluded.file_id}
+        ).returning(FileBlob.id, FileBlob.file_unique_id)
+        return {row.file_unique_id: row.id for row in self.db.session.execute(stmt)}
+
+    def _add_file_select_first(self, user_id, file_unique_id, **upload):
+        """Ingestion path for databases without INSERT ... ON CONFLICT"""
+        session = self.db.session
+        owned = (
+            select(FileMetadata)
+            .join(FileBlob, FileMetadata.blob_id == FileBlob.id)
+            .where(FileMetadata.user_id == user_id, FileBlob.file_unique_id == file_unique_id)
+        )
+        existing_file = session.scalars(owned).first()
+        if existing_file:
+            return existing_file, False
+
+        try:
+            blob = FileBlob.query.filter_by(file_unique_id=file_unique_id).first()
+            if blob is None:
+                blob = FileBlob(file_unique_id=file_unique_id, **blob_fields(upload))
+                session.add(blob)
+                session.flush()
+            file_metadata = FileMetadata(user_id=user_id, blob_id=blob.id, **entry_fields(upload))
+            session.add(file_metadata)
+            session.flush()
+            self._update_user_stats(user_id, 1, file_metadata.file_size or 0, file_metadata.upload_date)
+            session.commit()
+            session.refresh(file_metadata)
+            return file_metadata, True
+        except Exception:
+            session.rollback()
+            # A concurrent upload of the same content won the race
+            existing_file = session.scalars(owned).first()
+            if existing_file:
+                return existing_file, False
+            raise
+
+    def _list_files_page(self, user_id, before=None, after=None, limit=20, full_rows=False):
+        columns = FileMetadata.__table__.c if full_rows else LISTING_COLUMNS
+        query = select(*columns).where(FileMetadata.user_id == user_id)
+        return self._keyset_page(query, before, after, limit)
+
+    def _keyset_page(self, query, before, after, limit):
+        order_key = tuple_(FileMetadata.upload_date, FileMetadata.id)
+        if after is not None:
+            # Walking back towards newer files: scan ascending, then flip
+            query = query.where(order_key > tuple_(*after)).order_by(
+                FileMetadata.upload_date.asc(), FileMetadata.id.asc()
+            )
+        else:
+            if before is not None:
+                query = query.where(order_key < tuple_(*before))
+            query = query.order_by(FileMetadata.upload_date.desc(), FileMetadata.id.desc())
+
+        rows = self.db.session.execute(query.limit(limit + 1)).all()
+        return self._page_from_rows(rows, before, after, limit)
+
+    @staticmethod
+    def _page_from_rows(rows, before, after, limit):
+        """Build a FilePage from up to ``limit + 1`` rows read in scan order"""
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if after is not None:
+            rows.reverse()
+            return FilePage(rows, has_newer=has_more, has_older=True)
+        return FilePage(rows, has_newer=before is not None, has_older=has_more)
+
+    def _search_files_page(self, user_id, query, before=None, after=None, limit=20, prefix=False, full_rows=False):
+        if self.search_index is None:
+            # Served by the trigram indexes on filename and mime_type (migration 3)
+            escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            columns = FileMetadata.__table__.c if full_rows else LISTING_COLUMNS
+            statement = select(*columns).where(FileMetadata.user_id == user_id)
+            if prefix:
+                statement = statement.where(FileMetadata.filename.ilike(escaped + "%", escape="\\"))
+            else:
+                pattern = "%" + escaped + "%"
+                statement = statement.where(or_(
+                    FileMetadata.filename.ilike(pattern, escape="\\"),
+                    FileMetadata.mime_type.ilike(pattern, escape="\\")
+                ))
+            return self._keyset_page(statement, before, after, limit)
+
+        # The in-memory index holds full rows, so ``full_rows`` needs no extra query
+        matches = self.search_index.search(
+            user_id, query, partial(self._load_search_rows, user_id), prefix
+        )
+        position = attrgetter("upload_date", "id")
+        if after is not None:
+            rows = sorted((row for row in matches if position(row) > after), key=position)
+        else:
+            rows = sorted(
+                (row for row in matches if before is None or position(row) < before),
+                key=position, reverse=True
+            )
+        return self._page_from_rows(rows[:limit + 1], before, after, limit)
+
+    def _load_search_rows(self, user_id):
+        return self.db.session.execute(
+            select(*FileMetadata.__table__.c).where(FileMetadata.user_id == user_id)
+        ).all()
+
+    def _get_user_totals(self, user_id):
+        return self._get_user_stats(user_id)[:2]
+
+    def _get_user_stats(self, user_id):
+        stats = self.db.session.get(UserStats, user_id)
+        if stats is None:
+            return 0, 0, None
+        return stats.file_count, stats.total_bytes, stats.last_upload
+
+    def _delete_file(self, user_id, record_id):
+        session = self.db.session
+        file_metadata = FileMetadata.query.filter_by(id=record_id, user_id=user_id).first()
+        if file_metadata is None:
+            return False
+        session.delete(file_metadata)
+        self._update_user_stats(user_id, -1, -(file_metadata.file_size or 0))
+        session.commit()
+        return True
+
+    def _stats_increment(self, upsert, inserted):
+        """Build an upsert adding the rows of ``inserted`` to their owners' UserStats"""
+        stmt = upsert(UserStats).from_select(
+            ['user_id', 'file_count', 'total_bytes', 'last_upload'],
+            select(
+                inserted.c.user_id,
+                func.count(),
+                func.coalesce(func.sum(inserted.c.file_size), 0),
+                func.max(inserted.c.upload_date)
+            ).group_by(inserted.c.user_id)
+        )
+        return stmt.on_conflict_do_update(
+            index_elements=[UserStats.user_id],
+            set_={
+                'file_count': UserStats.file_count + stmt.excluded.file_count,
+                'total_bytes': UserStats.total_bytes + stmt.excluded.total_bytes,
+                'last_upload': func.coalesce(stmt.excluded.last_upload, UserStats.last_upload),
+            }
+        )
+
+    def _update_user_stats(self, user_id, file_delta, bytes_delta, uploaded_at=None):
+        """Apply a delta to the user's UserStats row inside the current transaction"""
+        session = self.db.session
+        upsert = dialect_insert(self.db)
+        if upsert is not None:
+            stmt = upsert(UserStats).values(
+                user_id=user_id,
+                file_count=max(file_delta, 0),
+                total_bytes=max(bytes_delta, 0),
+                last_upload=uploaded_at
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[UserStats.user_id],
+                set_={
+                    'file_count': UserStats.file_count + file_delta,
+                    'total_bytes': UserStats.total_bytes + bytes_delta,
+                    'last_upload': func.coalesce(stmt.excluded.last_upload, UserStats.last_upload),
+                }
+            )
+            session.execute(stmt)
+            return
+
+        # Generic fallback for databases without ON CONFLICT support
+        stats = session.get(UserStats, user_id, with_for_update=True)
+        if stats is None:
+            stats = UserStats(user_id=user_id, file_count=0, total_bytes=0)
+            session.add(stats)
+        stats.file_count += file_delta
+        stats.total_bytes += bytes_delta
+        if uploaded_at is not None:
+            stats.last_upload = uploaded_at
+
+    def _get_files(self, user_id, record_ids):
+        rows = self.db.session.execute(
+            select(*FileMetadata.__table__.c)
+            .where(FileMetadata.user_id == user_id, FileMetadata.id.in_(record_ids))
+        ).all()
+        by_id = {row.id: FileRecord(**row._mapping) for row in rows}
+        return [by_id[record_id] for record_id in record_ids if record_id in by_id]
+
+    def _get_file(self, record_id):
+        row = self.db.session.execute(
+            select(*FileMetadata.__table__.c).where(FileMetadata.id == record_id)
+        ).first()
+        return FileRecord(**row._mapping) if row is not None else None
+
+    def _add_pending_deletions(self, chat_id, message_ids, delay):
+        next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+        rows = [
+            {'chat_id': chat_id, 'message_id': message_id, 'next_attempt_at': next_attempt_at}
+            for message_id in message_ids
+        ]
+        upsert = dialect_insert(self.db)
+        if upsert is not None:
+            stmt = upsert(PendingDeletion).values(rows).on_conflict_do_nothing()
+        else:
+            stmt = insert(PendingDeletion).values(rows)
+        self.db.session.execute(stmt)
+        self.db.session.commit()
+
+    def _remove_pending_deletions(self, chat_id, message_ids):
+        self.db.session.execute(
+            delete(PendingDeletion)
+            .where(PendingDeletion.chat_id == chat_id, PendingDeletion.message_id.in_(message_ids))
+        )
+        self.db.session.commit()
+
+    def _retry_pending_deletions_later(self, chat_id, message_ids, delay, max_attempts):
+        session = self.db.session
+        condition = (PendingDeletion.chat_id == chat_id) & PendingDeletion.message_id.in_(message_ids)
+        session.execute(
+            update(PendingDeletion)
+            .where(condition)
+            .values(
+                attempts=PendingDeletion.attempts + 1,
+                next_attempt_at=datetime.utcnow() + timedelta(seconds=delay)
+            )
+        )
+        given_up = session.execute(
+            delete(PendingDeletion).where(condition, PendingDeletion.attempts >= max_attempts)
+        ).rowcount
+        session.commit()
+        return given_up
+
+    def _claim_due_pending_deletions(self, limit, lease):
+        now = datetime.utcnow()
+        due = (
+            select(PendingDeletion.chat_id, PendingDeletion.message_id)
+            .where(PendingDeletion.next_attempt_at <= now)
+            .order_by(PendingDeletion.next_attempt_at)
+            .limit(limit)
+            # Another worker claiming at the same time skips the rows locked here
+            .with_for_update(skip_locked=True)
+        )
+        # One statement, so two claims never return the same row
+        rows = self.db.session.execute(
+            update(PendingDeletion)
+            .where(
+                tuple_(PendingDeletion.chat_id, PendingDeletion.message_id).in_(due),
+                PendingDeletion.next_attempt_at <= now
+            )
+            .values(next_attempt_at=now + timedelta(seconds=lease))
+            .returning(PendingDeletion.chat_id, PendingDeletion.message_id)
+        ).all()
+        self.db.session.commit()
+        return rows
+
+    def _save_user_state(self, user_id, **values):
+        values['updated_at'] = datetime.utcnow()
+        upsert = dialect_insert(self.db)
+        if upsert is not None:
+            stmt = upsert(UserState).values(user_id=user_id, **values)
+            stmt = stmt.on_conflict_do_update(index_elements=[UserState.user_id], set_=values)
+            self.db.session.execute(stmt)
+        elif self.db.session.get(UserState, user_id) is None:
+            self.db.session.execute(insert(UserState).values(user_id=user_id, **values))
+        else:
+            self.db.session.execute(update(UserState).where(UserState.user_id == user_id).values(**values))
+        self.db.session.commit()
+
+    def _get_search_query(self, user_id):
+        return self.db.session.scalar(select(UserState.search_query).where(UserState.user_id == user_id))
+
+    def _get_selection(self, user_id):
+        row = self.db.session.execute(
+            select(UserState.selection_page, UserState.selected_ids).where(UserState.user_id == user_id)
+        ).first()
+        if row is None or row.selection_page is None:
+            return None
+        return Selection(row.selection_page, set(row.selected_ids or ()))
+
+    def _toggle_selected(self, user_id, record_id):
+        session = self.db.session
+        # Lock the row so taps handled by two workers at once both count
+        state = session.execute(
+            select(UserState).where(UserState.user_id == user_id).with_for_update()
+        ).scalar_one_or_none()
+        if state is None:
+            state = UserState(user_id=user_id)
+            session.add(state)
+        if state.selection_page is None:
+            state.selection_page = ""
+        selection = Selection(state.selection_page, set(state.selected_ids or ()) ^ {record_id})
+        state.selected_ids = sorted(selection.ids)
+        state.updated_at = datetime.utcnow()
+        session.commit()
+        return selection
+
+    def _add_failed_update(self, update_id, payload, error, attempts):
+        self.db.session.execute(insert(FailedUpdate).values(
+            update_id=update_id, payload=payload, error=error, attempts=attempts, failed_at=datetime.utcnow()
+        ))
+        self.db.session.commit()
+
+    # Async API used by the handlers
+
+    async def add_file(self, user_id, file_id, file_unique_id, filename, file_size=None, mime_type=None, media_kind="document"):
+        """Store a file for a user; returns ``(record, created)``"""
+        upload = dict(
+            file_id=file_id, file_unique_id=file_unique_id, filename=filename,
+            file_size=file_size, mime_type=mime_type, media_kind=media_kind
+        )
+        results = await self.add_files(user_id, [upload])
+        return results[0]
+
+    async def add_files(self, user_id, uploads):
+        """Store several files for a user in one transaction.
+
+        ``uploads`` are dicts with ``file_id``, ``file_unique_id``, ``filename``,
+        ``file_size``, ``mime_type`` and ``media_kind``; returns a ``(record,
+        created)`` pair for each, in order. Content is matched on
+        ``file_unique_id``, so ``created`` is False when the user already
+        stored the same file, even under a different file_id.
+        """
+        results = await self._run(self._add_files, user_id, uploads)
+        if self.search_index is not None:
+            self.search_index.add(user_id, [record for record, created in results if created])
+        if self.page_cache is not None and any(created for record, created in results):
+            self.page_cache.invalidate(user_id)
+        return results
+
+    async def list_files_page(self, user_id, before=None, after=None, limit=20, full_rows=False):
+        """Return one page of a user's files, newest first.
+
+        ``before`` and ``after`` are ``(upload_date, id)`` keyset cursors; only
+        ``limit + 1`` rows are read regardless of how many files the user has.
+        Rows carry the listing columns unless ``full_rows`` is set.
+        """
+        return await self._run(self._list_files_page, user_id, before, after, limit, full_rows)
+
+    async def search_files_page(self, user_id, query, before=None, after=None, limit=20, prefix=False, full_rows=False):
+        """Return one page of a user's files whose filename or MIME type contains ``query``.
+
+        With ``prefix`` set, only filenames starting with ``query`` match.
+        ``query`` must already be normalized (see ``search.normalize_query``).
+        Pages are newest first and use the same keyset cursors as
+        ``list_files_page``; rows carry the listing columns unless
+        ``full_rows`` is set.
+        """
+        return await self._run(self._search_files_page, user_id, query, before, after, limit, prefix, full_rows)
+
+    async def get_files(self, user_id, record_ids):
+        """Return a user's files with the given ids in one query, in the given order"""
+        return await self._run(self._get_files, user_id, record_ids)
+
+    async def get_user_totals(self, user_id):
+        """Return ``(file_count, total_bytes)`` for a user from their UserStats row"""
+        return await self._run(self._get_user_totals, user_id)
+
+    async def get_user_stats(self, user_id):
+        """Return ``(file_count, total_bytes, last_upload)``; changes whenever the user's files do"""
+        return await self._run(self._get_user_stats, user_id)
+
+    async def delete_file(self, user_id, record_id):
+        """Delete one of a user's files; returns False if it was not theirs or missing.
+
+        The shared FileBlob is kept, so a later upload of the same content finds it again.
+        """
+        deleted = await self._run(self._delete_file, user_id, record_id)
+        if deleted and self.search_index is not None:
+            self.search_index.remove(user_id, record_id)
+        if deleted and self.page_cache is not None:
+            self.page_cache.invalidate(user_id)
+        if deleted and self.file_cache is not None:
+            await self.file_cache.invalidate(f"file:{record_id}")
+        return deleted
+
+    async def get_file(self, record_id):
+        """Return a single file by its database id, or None.
+
+        Rows never change after insert, so lookups are served from the file
+        cache when one is configured.
+        """
+        if self.file_cache is None:
+            return await self._run(self._get_file, record_id)
+        return await self.file_cache.get_or_load(
+            f"file:{record_id}", partial(self._run, self._get_file, record_id)
+        )
+
+    async def add_pending_deletions(self, chat_id, message_ids, delay=0):
+        """Persist messages queued for deletion so a restart does not lose them.
+
+        They become due for claim_due_pending_deletions() after ``delay``
+        seconds, which leaves them to the caller until then.
+        """
+        await self._run(self._add_pending_deletions, chat_id, message_ids, delay)
+
+    async def remove_pending_deletions(self, chat_id, message_ids):
+        """Forget messages that were deleted (or given up on)"""
+        await self._run(self._remove_pending_deletions, chat_id, message_ids)
+
+    async def retry_pending_deletions_later(self, chat_id, message_ids, delay, max_attempts):
+        """Push failed deletions back by ``delay`` seconds; returns how many ran out of attempts"""
+        return await self._run(self._retry_pending_deletions_later, chat_id, message_ids, delay, max_attempts)
+
+    async def claim_due_pending_deletions(self, lease, limit=500):
+        """Return ``(chat_id, message_id)`` rows whose next attempt is due, pushing them back by ``lease`` seconds.
+
+        The claimed rows are not due again until the lease ends, so workers
+        sweeping at the same time do not delete the same messages.
+        """
+        return await self._run(self._claim_due_pending_deletions, limit, lease)
+
+    async def get_search_query(self, user_id):
+        """Return the user's last /search query, or None"""
+        return await self._run(self._get_search_query, user_id)
+
+    async def set_search_query(self, user_id, query):
+        """Remember the user's /search query for paging; it may not fit in callback_data"""
+        await self._run(self._save_user_state, user_id, search_query=query)
+
+    async def get_selection(self, user_id):
+        """Return the user's multi-select ``Selection``, or None outside multi-select mode"""
+        return await self._run(self._get_selection, user_id)
+
+    async def start_selection(self, user_id, page_token):
+        """Enter multi-select mode on a /myfiles page with nothing selected"""
+        await self._run(self._save_user_state, user_id, selection_page=page_token, selected_ids=[])
+
+    async def toggle_selected(self, user_id, record_id):
+        """Select or unselect a file; returns the updated ``Selection``"""
+        return await self._run(self._toggle_selected, user_id, record_id)
+
+    async def clear_selection(self, user_id):
+        """Leave multi-select mode"""
+        await self._run(self._save_user_state, user_id, selection_page=None, selected_ids=None)
+
+    async def add_failed_update(self, update_id, payload, error, attempts):
+        """Dead-letter an update whose handlers kept failing; ``payload`` is the update as JSON"""
+        await self._run(self._add_failed_update, update_id, payload, error, attempts)
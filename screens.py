@@ -0,0 +1,101 @@
+import os
+import hashlib
+import logging
+
+from telegram.constants import ParseMode
+from telegram.error import BadRequest
+
+from cache import LRUCache
+from metrics import SCREENS_RENDERED
+
+logger = logging.getLogger(__name__)
+
+
+def _digest(data):
+    return hashlib.blake2b(data.encode(), digest_size=16).digest()
+
+
+def screen_digests(screen):
+    """Hashes of a Screen's text and of its keyboard, compared to detect no-op edits"""
+    markup = screen.reply_markup.to_json() if screen.reply_markup else ""
+    return _digest(screen.text), _digest(markup)
+
+
+class ScreenRenderer:
+    """Shows Screens, editing the tapped message in place when a button triggered them.
+
+    Commands get a new message. Callbacks edit the message the button belongs
+    to. The renderer remembers hashes of the text and keyboard last rendered
+    into each message, up to ``max_messages`` for ``ttl`` seconds:
+
+    - an edit that would change nothing is skipped;
+    - a change to the keyboard alone uses editMessageReplyMarkup;
+    - "message is not modified" from Telegram, e.g. once the hash was
+      evicted, counts as done.
+
+    With ``shared`` set, other processes (e.g. gunicorn workers) edit the
+    same messages, so the hashes here may be stale. Every edit is then sent,
+    and only Telegram's "not modified" answer detects no-ops.
+    """
+
+    def __init__(self, max_messages=None, ttl=None, shared=False):
+        self.shared = shared
+        self._rendered = LRUCache(
+            max_entries=max_messages or int(os.environ.get("SCREEN_CACHE_SIZE", 10000)),
+            ttl=ttl or float(os.environ.get("SCREEN_CACHE_TTL", 86400))
+        )
+
+    def stats(self):
+        return self._rendered.stats()
+
+    @staticmethod
+    def _message_key(query):
+        """Key of the message a callback query can edit, or None if it has no editable text"""
+        if query.inline_message_id:
+            return ("inline", query.inline_message_id)
+        message = query.message
+        if message is None or not message.is_accessible or message.text is None:
+            # Too old to edit, or a media message (e.g. a sent file) whose caption is not a screen
+            return None
+        return (message.chat_id, message.message_id)
+
+    async def show(self, update, screen):
+        """Render ``screen`` in reply to ``update``; returns the new Message, or None if one was edited"""
+        digests = screen_digests(screen)
+        query = update.callback_query
+        key = self._message_key(query) if query else None
+        if key is None:
+            if query:
+                message = await update.effective_chat.send_message(
+                    screen.text, parse_mode=ParseMode.HTML, reply_markup=screen.reply_markup
+                )
+            else:
+                message = await update.effective_message.reply_text(
+                    screen.text, parse_mode=ParseMode.HTML, reply_markup=screen.reply_markup
+                )
+            if not self.shared:
+                self._rendered.set((message.chat_id, message.message_id), digests)
+            SCREENS_RENDERED.inc(action="send")
+            return message
+
+        previous = None if self.shared else self._rendered.get(key)
+        if previous == digests:
+            SCREENS_RENDERED.inc(action="unchanged")
+            return None
+        try:
+            if previous is not None and previous[0] == digests[0]:
+                await query.edit_message_reply_markup(reply_markup=screen.reply_markup)
+                action = "edit_markup"
+            else:
+                await query.edit_message_text(
+                    screen.text, parse_mode=ParseMode.HTML, reply_markup=screen.reply_markup
+                )
+                action = "edit"
+        except BadRequest as e:
+            if "not modified" not in e.message.lower():
+                raise
+            action = "unchanged"
+        if not self.shared:
+            self._rendered.set(key, digests)
+        SCREENS_RENDERED.inc(action=action)
+        return None
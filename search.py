@@ -0,0 +1,116 @@
+import os
+from threading import Lock
+
+from cache import LRUCache
+
+# Longest search query accepted from users
+MAX_QUERY_LENGTH = 64
+
+
+def normalize_query(query):
+    """Collapse whitespace and case so equal queries share cursors and index lookups"""
+    return " ".join(query.split()).lower()[:MAX_QUERY_LENGTH]
+
+
+def searchable_text(row):
+    """The text a file is matched against; the newline keeps matches inside one field"""
+    return f"{row.filename or ''}\n{row.mime_type or ''}".lower()
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class UserSearchIndex:
+    """Trigram postings over one user's files.
+
+    A query is answered by intersecting the postings of its trigrams, starting
+    with the rarest, and then checking the few candidates for a real substring
+    match. Queries shorter than three characters check every file.
+    """
+
+    def __init__(self, rows=()):
+        self.rows = {}
+        self.postings = {}
+        for row in rows:
+            self.add(row)
+
+    def add(self, row):
+        self.remove(row.id)
+        self.rows[row.id] = row
+        for gram in trigrams(searchable_text(row)):
+            self.postings.setdefault(gram, set()).add(row.id)
+
+    def remove(self, record_id):
+        row = self.rows.pop(record_id, None)
+        if row is None:
+            return
+        for gram in trigrams(searchable_text(row)):
+            ids = self.postings.get(gram)
+            if ids is not None:
+                ids.discard(record_id)
+                if not ids:
+                    del self.postings[gram]
+
+    def search(self, query, prefix=False):
+        """Return the rows whose filename or MIME type contains ``query``, or whose filename starts with it"""
+        grams = trigrams(query)
+        if grams:
+            postings = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+        else:
+            candidates = self.rows.keys()
+        if prefix:
+            return [self.rows[record_id] for record_id in candidates if searchable_text(self.rows[record_id]).startswith(query)]
+        return [self.rows[record_id] for record_id in candidates if query in searchable_text(self.rows[record_id])]
+
+
+class MemorySearchIndex:
+    """In-process search index used when the database has no trigram support (SQLite).
+
+    Each user's index is built from the database on their first search and kept
+    in an LRU, so memory stays bounded by ``max_users``. The repository adds and
+    removes rows as files are stored and deleted; entries also expire after
+    ``ttl`` seconds, which bounds how long a missed update can go unnoticed.
+    """
+
+    def __init__(self, max_users=256, ttl=600):
+        self._users = LRUCache(max_entries=max_users, ttl=ttl)
+        self._lock = Lock()
+
+    def search(self, user_id, query, load_rows, prefix=False):
+        """Search a user's files, building their index with ``load_rows()`` if needed"""
+        with self._lock:
+            index = self._users.get(user_id)
+        if index is None:
+            index = UserSearchIndex(load_rows())
+            with self._lock:
+                self._users.set(user_id, index)
+        with self._lock:
+            return index.search(query, prefix)
+
+    def add(self, user_id, rows):
+        with self._lock:
+            index = self._users.peek(user_id)
+            if index is not None:
+                for row in rows:
+                    index.add(row)
+
+    def remove(self, user_id, record_id):
+        with self._lock:
+            index = self._users.peek(user_id)
+            if index is not None:
+                index.remove(record_id)
+
+    def stats(self):
+        return self._users.stats()
+
+
+def build_search_index(db):
+    """Create the fallback search index, or None when Postgres trigram indexes serve searches"""
+    if db.engine.dialect.name == "postgresql":
+        return None
+    return MemorySearchIndex(
+        max_users=int(os.environ.get("SEARCH_INDEX_USERS", 256)),
+        ttl=float(os.environ.get("SEARCH_INDEX_TTL", 600))
+    )
@@ -0,0 +1,324 @@
+from collections import namedtuple
+from html import escape
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# Files listed individually in a batch upload confirmation
+BATCH_SUMMARY_LINES = 10
+
+# A complete reply: HTML text plus its inline keyboard (or None)
+Screen = namedtuple("Screen", ["text", "reply_markup"])
+
+
+def format_file_size(size_bytes):
+    """Format file size in human readable format"""
+    if size_bytes is None:
+        return "Unknown size"
+    
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size_bytes < 1024.0:
+            return f"{size_bytes:.1f} {unit}"
+        size_bytes /= 1024.0
+    return f"{size_bytes:.1f} TB"
+
+
+def format_date(date_obj):
+    """Format date in a user-friendly way"""
+    if date_obj is None:
+        return "Unknown date"
+    return date_obj.strftime("%B %d, %Y at %I:%M %p")
+
+
+WELCOME_TEXT = """
+🌟 <b>Welcome to @SAN_mediabot!</b> 🌟
+
+🚀 <i>Your personal cloud storage assistant</i>
+
+<b>✨ What I can do for you:</b>
+📁 Store any type of file securely
+📋 Keep track of all your uploads
+💾 Easy file retrieval anytime
+🔍 Smart file management
+
+<b>🎯 Quick Commands:</b>
+/myfiles - 📂 View all your files
+/search - 🔍 Find files by name
+/start - 🏠 Show this welcome message
+/help - ❓ Get detailed help
+
+<b>📤 Getting Started:</b>
+Simply send me any file and I'll store it safely for you!
+
+<i>Built with ❤️ for premium experience</i>
+"""
+
+HELP_TEXT = """
+🔧 <b>How to Use @SAN_mediabot</b> 🔧
+
+<b>📤 Uploading Files:</b>
+• Send any file directly to this chat
+• Supported: Documents, Images, Videos, Audio, etc.
+• Files are stored securely with metadata
+
+<b>📁 Managing Files:</b>
+• Use /myfiles to see all your uploaded files
+• Click any file button to download instantly
+• Files are organized by upload date
+• Use /search &lt;name&gt; to find files by name or type
+
+<b>🔍 File Information:</b>
+• File name and size are preserved
+• Upload timestamp is recorded
+• Easy one-click download access
+
+<b>⚡ Pro Tips:</b>
+• Send multiple files at once
+• Use descriptive filenames for easy identification
+• Your files are private and secure
+
+<b>🆘 Need Support?</b>
+For any queries contact @takezo_5
+"""
+
+UPLOAD_GUIDE_TEXT = """
+📤 <b>How to Upload Files</b>
+
+🎯 <i>It's super simple!</i>
+
+<b>Just send me any file:</b>
+• 📄 Documents (PDF, DOC, TXT, etc.)
+• 🖼️ Images (JPG, PNG, GIF, etc.)
+• 🎥 Videos (MP4, AVI, MOV, etc.)
+• 🎵 Audio (MP3, WAV, OGG, etc.)
+• 🗣️ Voice messages
+• 📹 Video notes
+
+<b>✨ Pro Tips:</b>
+• Send multiple files at once
+• Original quality is preserved
+• Instant secure storage
+• One-click download later
+
+<i>Ready? Send your first file now! 🚀</i>
+"""
+
+EMPTY_FILES_TEXT = """
+📂 <b>Your File Storage is Empty</b>
+
+🌟 <i>Ready to get started?</i>
+
+Upload your first file by sending any document, image, video, or audio file to this chat!
+
+<b>✨ Pro Features:</b>
+• Unlimited file types supported
+• Instant download access
+• Secure cloud storage
+• Smart file organization
+"""
+
+
+# Static screens are built once at import and shared by every request;
+# InlineKeyboardMarkup objects are immutable, so reusing them is safe
+WELCOME = Screen(WELCOME_TEXT, InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📂 My Files", callback_data="my_files"),
+        InlineKeyboardButton("❓ Help", callback_data="help")
+    ],
+    [
+        InlineKeyboardButton("🚀 Upload First File", callback_data="upload_guide")
+    ]
+]))
+
+HELP = Screen(HELP_TEXT, InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📂 View My Files", callback_data="my_files"),
+        InlineKeyboardButton("🏠 Home", callback_data="start")
+    ]
+]))
+
+UPLOAD_GUIDE = Screen(UPLOAD_GUIDE_TEXT, InlineKeyboardMarkup([
+    [InlineKeyboardButton("📂 View My Files", callback_data="my_files")],
+    [InlineKeyboardButton("🏠 Back to Home", callback_data="start")]
+]))
+
+EMPTY_FILES = Screen(EMPTY_FILES_TEXT, InlineKeyboardMarkup([
+    [InlineKeyboardButton("📤 Upload Your First File", callback_data="upload_guide")]
+]))
+
+# Static screens reachable from inline buttons, by callback_data
+STATIC_SCREENS = {
+    "start": WELCOME,
+    "help": HELP,
+    "upload_guide": UPLOAD_GUIDE,
+}
+
+# Shared keyboards for parameterized replies
+SHOW_MY_FILES_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📂 Show My Files", callback_data="my_files")]
+])
+
+SEARCH_FOOTER = (
+    InlineKeyboardButton("📂 All My Files", callback_data="my_files"),
+)
+
+DOWNLOAD_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📂 Back to Files", callback_data="my_files"),
+        InlineKeyboardButton("📤 Upload New", callback_data="upload_guide")
+    ]
+])
+
+FILE_LIST_FOOTER = (
+    InlineKeyboardButton("📤 Upload New File", callback_data="upload_guide"),
+    InlineKeyboardButton("🔄 Refresh", callback_data="my_files")
+)
+
+UPLOAD_FAILED_TEXT = (
+    "❌ <b>Upload Failed</b>\n\n"
+    "Sorry, there was an error processing your file. Please try again."
+)
+
+BATCH_UPLOAD_FAILED_TEXT = (
+    "❌ <b>Upload Failed</b>\n\n"
+    "Sorry, there was an error processing your files. Please try again."
+)
+
+FILES_ERROR_TEXT = (
+    "❌ <b>Error Loading Files</b>\n\n"
+    "Sorry, there was an error retrieving your files. Please try again."
+)
+
+CALLBACK_ERROR_TEXT = "❌ <b>Error</b>\n\nSorry, there was an error processing your request."
+
+UNSUPPORTED_FILE_TEXT = "❌ Sorry, I couldn't process this file type."
+
+FILE_NOT_FOUND_TEXT = "❌ File not found or has been deleted."
+
+SEARCH_USAGE_TEXT = (
+    "🔍 <b>Search Your Files</b>\n\n"
+    "Send /search followed by part of a filename or file type, e.g.\n"
+    "<code>/search invoice</code> or <code>/search pdf</code>"
+)
+
+NOTHING_SELECTED_TEXT = "ℹ️ <b>No files selected</b>\n\nTap ☑️ Select Files and pick the files you want."
+
+
+def upload_confirmation_text(upload, file_metadata, created):
+    """Build the confirmation text for a single stored file"""
+    if created:
+        success_message = "File Uploaded Successfully!"
+    else:
+        success_message = "File already exists in your storage!"
+    
+    # Success response with premium styling
+    return f"""
+✅ <b>{success_message}</b>
+
+📁 <b>File Details:</b>
+🔸 Name: <code>{escape(upload['filename'])}</code>
+🔸 Size: <code>{format_file_size(file_metadata.file_size)}</code>
+🔸 Type: <code>{escape(file_metadata.mime_type or upload['mime_type'] or 'Unknown')}</code>
+🔸 Uploaded: <code>{format_date(file_metadata.upload_date)}</code>
+
+🎉 <i>Your file is safely stored! Use /myfiles to view and download all your files.</i>
+
+💡 <b>Note:</b> Telegram supports files up to 2GB. For larger files, consider splitting them or using compression.
+"""
+
+
+def batch_confirmation_text(uploads, results):
+    """Build one summary confirmation for a batch of stored files"""
+    stored = sum(1 for _, created in results if created)
+    duplicates = len(results) - stored
+    total_size = sum(file_metadata.file_size or 0 for file_metadata, _ in results)
+    
+    lines = []
+    for upload, (file_metadata, created) in list(zip(uploads, results))[:BATCH_SUMMARY_LINES]:
+        marker = "🔸" if created else "♻️"
+        lines.append(
+            f"{marker} <code>{escape(upload['filename'])}</code> - {format_file_size(file_metadata.file_size)}"
+        )
+    if len(results) > BATCH_SUMMARY_LINES:
+        lines.append(f"<i>...and {len(results) - BATCH_SUMMARY_LINES} more</i>")
+    file_lines = "\n".join(lines)
+    
+    duplicates_line = ""
+    if duplicates:
+        duplicates_line = f"\n♻️ <i>{duplicates} already in your storage</i>"
+    
+    return f"""
+✅ <b>{stored} Files Uploaded Successfully!</b>
+
+📁 <b>Files:</b>
+{file_lines}
+
+📊 <b>Total Size:</b> <code>{format_file_size(total_size)}</code>{duplicates_line}
+
+🎉 <i>Your files are safely stored! Use /myfiles to view and download all your files.</i>
+"""
+
+
+def download_caption_text(file_metadata):
+    """Build the caption sent along with a downloaded file"""
+    return f"""
+💾 <b>Downloading: {escape(file_metadata.filename)}</b>
+
+📊 <b>File Info:</b>
+🔸 Size: <code>{format_file_size(file_metadata.file_size)}</code>
+🔸 Uploaded: <code>{format_date(file_metadata.upload_date)}</code>
+
+⬇️ <i>File sent successfully!</i>
+"""
+
+
+def download_done_text(file_metadata):
+    """Build the text that replaces the file list after a download"""
+    return f"✅ <b>File Downloaded!</b>\n\n📁 <code>{escape(file_metadata.filename)}</code> has been sent to you."
+
+
+def bulk_item_caption(file_metadata):
+    """Build the short caption for one file of a bulk delivery (also used for inline results)"""
+    return f"📁 <code>{escape(file_metadata.filename)}</code>"
+
+
+def inline_result_description(file_metadata):
+    """Build the second line of an inline query result"""
+    return f"{format_file_size(file_metadata.file_size)} · {format_date(file_metadata.upload_date)}"
+
+
+def bulk_sent_text(count):
+    """Build the text that replaces the file list after a bulk delivery"""
+    noun = "File" if count == 1 else "Files"
+    return f"✅ <b>{count} {noun} Sent!</b>\n\n📁 Your files have been sent to this chat."
+
+
+def file_list_header_text(total_files, total_bytes):
+    """Build the /myfiles header"""
+    return f"""
+📂 <b>Your Premium File Storage</b>
+
+🗂️ <i>Total Files: {total_files}</i>
+📊 <i>Storage Used: {format_file_size(total_bytes)}</i>
+
+💎 <b>Select any file to download:</b>
+"""
+
+
+def search_results_header_text(query):
+    """Build the header of a /search results page"""
+    return f"""
+🔍 <b>Search Results</b>
+
+🔸 Query: <code>{escape(query)}</code>
+
+💎 <b>Select any file to download:</b>
+"""
+
+
+def no_search_results_text(query):
+    """Build the reply for a search without matches"""
+    return (
+        f"🔍 <b>No Files Found</b>\n\n"
+        f"Nothing in your storage matches <code>{escape(query)}</code>.\n"
+        f"Try a shorter part of the name, or /myfiles to browse everything."
+    )
@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+
+from sqlalchemy import delete, insert
+from sqlalchemy.exc import IntegrityError, InterfaceError, OperationalError
+from telegram import Update
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.ext import BaseUpdateProcessor
+
+from cache import LRUCache
+from metrics import UPDATE_DUPLICATES, UPDATE_RETRIES, UPDATES_DEAD_LETTERED
+from models import ProcessedUpdate
+from outbound import TokenBucket
+from repository import dialect_insert
+
+logger = logging.getLogger(__name__)
+
+# Limit handed to PTB's own semaphore, which is taken before do_process_update
+# and must never make updates wait; the real limit is ``limit`` below
+UNBOUNDED = 1_000_000
+
+
+def is_transient(error):
+    """Whether ``error`` may go away on retry: a database connection problem or a failed Telegram call"""
+    if isinstance(error, BadRequest):
+        # Telegram rejected the request itself; sending it again gets the same answer
+        return False
+    return isinstance(error, (OperationalError, InterfaceError, NetworkError, RetryAfter))
+
+
+def update_chat_key(update):
+    """The chat whose updates must be handled in order, or None if the update can go anywhere"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        # Inline queries have no chat; keep each user's queries in order
+        return ("user", update.effective_user.id)
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Process updates from different chats concurrently, one at a time within a chat.
+
+    Up to ``max_concurrent_updates`` handlers run at once. An update waits for
+    the previous update of its chat before taking a slot, so a busy chat never
+    holds slots that other chats could use. Messages sent before the bot
+    started (the backlog Telegram kept while it was down) are admitted at
+    ``backlog_rate`` updates per second, behind live updates.
+    """
+
+    def __init__(self, max_concurrent_updates=None, backlog_rate=None):
+        # Waiting on PTB's semaphore could reorder a chat's updates, so it is
+        # sized never to fill up (max_concurrent_updates reports that size)
+        super().__init__(UNBOUNDED)
+        self.limit = max_concurrent_updates or int(os.environ.get("UPDATE_CONCURRENCY", 8))
+        self.backlog_rate = backlog_rate or float(os.environ.get("UPDATE_BACKLOG_RATE", 20))
+        self.started = None
+        self._slots = None
+        self._backlog = None
+        self._chats = {}
+        self._waiting = 0
+
+    @property
+    def pending(self):
+        """Updates received but not yet handed to a handler"""
+        return self._waiting
+
+    async def initialize(self):
+        # Message dates have whole-second precision
+        self.started = datetime.now(timezone.utc).replace(microsecond=0)
+        self._slots = asyncio.Semaphore(self.limit)
+        self._backlog = TokenBucket(self.backlog_rate, max(self.backlog_rate, 1))
+        logger.info(
+            f"Processing up to {self.limit} updates at once, in order per chat; "
+            f"backlog drains at {self.backlog_rate:g} updates/s"
+        )
+
+    async def shutdown(self):
+        self._chats.clear()
+
+    def _is_backlog(self, update):
+        message = update.message if isinstance(update, Update) else None
+        return bool(message and self.started and message.date < self.started)
+
+    async def do_process_update(self, update, coroutine):
+        key = update_chat_key(update)
+        entry = None
+        if key is not None:
+            # [lock, updates holding or waiting for it]; dropped when the chat goes idle
+            entry = self._chats.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+
+        self._waiting += 1
+        waiting = True
+        try:
+            if entry:
+                # asyncio.Lock hands over in FIFO order, which keeps the chat's updates in sequence
+                await entry[0].acquire()
+            try:
+                if self._is_backlog(update):
+                    await self._backlog.acquire()
+                async with self._slots:
+                    self._waiting -= 1
+                    waiting = False
+                    await coroutine
+            finally:
+                if entry:
+                    entry[0].release()
+        finally:
+            if waiting:
+                self._waiting -= 1
+            if entry:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._chats[key]
+
+
+class SeenUpdates:
+    """Bounded record of the update ids already accepted, each kept for ``ttl`` seconds.
+
+    Telegram redelivers an update when it gets no timely 2xx, e.g. after a
+    timeout or a dropped connection. The webhook claims every update id here
+    before queueing it and acknowledges redeliveries without running the
+    handlers again. Ids live in a local LRU; with ``db`` set they are also
+    inserted into the processed_updates table, so a redelivery routed to a
+    different worker is caught as well. Claims made through ``db`` need an
+    app context.
+    """
+
+    def __init__(self, max_entries=100000, ttl=86400, db=None):
+        self.local = LRUCache(max_entries=max_entries, ttl=ttl)
+        self.ttl = ttl
+        self.db = db
+        self._lock = Lock()
+        self._next_prune = 0.0
+
+    def claim(self, update_id):
+        """Record ``update_id``; returns False if it was already claimed, i.e. the update is a redelivery"""
+        with self._lock:
+            seen = self.local.get(update_id) is not None
+            if not seen:
+                self.local.set(update_id, True)
+        if not seen and self.db is not None:
+            seen = not self._claim_shared(update_id)
+        if seen:
+            UPDATE_DUPLICATES.inc()
+        return not seen
+
+    def _claim_shared(self, update_id):
+        upsert = dialect_insert(self.db)
+        try:
+            with self.db.engine.begin() as conn:
+                if upsert is not None:
+                    claimed = conn.execute(
+                        upsert(ProcessedUpdate)
+                        .values(update_id=update_id, received_at=datetime.utcnow())
+                        .on_conflict_do_nothing()
+                    ).rowcount == 1
+                else:
+                    try:
+                        with conn.begin_nested():
+                            conn.execute(insert(ProcessedUpdate).values(update_id=update_id, received_at=datetime.utcnow()))
+                        claimed = True
+                    except IntegrityError:
+                        claimed = False
+                if time.monotonic() >= self._next_prune:
+                    # Ids older than the TTL can no longer be redelivered usefully
+                    self._next_prune = time.monotonic() + min(self.ttl, 60)
+                    conn.execute(delete(ProcessedUpdate).where(
+                        ProcessedUpdate.received_at < datetime.utcnow() - timedelta(seconds=self.ttl)
+                    ))
+            return claimed
+        except Exception as e:
+            # Better to risk a duplicate than to drop an update
+            logger.warning(f"Could not record update {update_id} in processed_updates: {e}")
+            return True
+
+
+def build_seen_updates(db):
+    """Create the webhook's seen-update store from the SEEN_UPDATES_* settings"""
+    shared = os.environ.get("SEEN_UPDATES_SHARED", "").lower() in ("1", "true", "yes")
+    return SeenUpdates(
+        max_entries=int(os.environ.get("SEEN_UPDATES_SIZE", 100000)),
+        ttl=float(os.environ.get("SEEN_UPDATES_TTL", 86400)),
+        db=db if shared else None
+    )
+
+
+class UpdateRetry:
+    """Retries failed updates, then dead-letters them.
+
+    Installed as the application's error handler. A failed update goes back
+    on the application's update queue after ``delay`` seconds, doubling each
+    time, up to ``max_retries`` times. After that, or at once if the error is
+    not transient, it is stored in the failed_updates table through ``repo``
+    and ``notify(update)`` tells the user. Retried updates run the handlers
+    again from the start, and only after any newer updates from their chat,
+    so handlers must only let errors escape while running them again is safe.
+
+    Work outside a handler (e.g. storing an upload batch) retries a single
+    step with ``call()`` on the same schedule and gives up with
+    ``dead_letter()``.
+    """
+
+    def __init__(self, application, repo, notify=None, max_retries=None, delay=None, max_tracked=10000):
+        self.application = application
+        self.repo = repo
+        self.notify = notify
+        self.max_retries = max_retries if max_retries is not None else int(os.environ.get("UPDATE_MAX_RETRIES", 2))
+        self.delay = delay if delay is not None else float(os.environ.get("UPDATE_RETRY_DELAY", 5))
+        # Attempts per update id; an hour is far longer than any retry schedule
+        self._attempts = LRUCache(max_entries=max_tracked, ttl=3600)
+
+    async def __call__(self, update, context):
+        if not isinstance(update, Update):
+            logger.error(f"Error outside of an update: {context.error}")
+            return
+        await self.handle(update, context.error)
+
+    async def handle(self, update, error, retryable=None):
+        """Retry ``update`` after it failed with ``error``, or dead-letter it.
+
+        ``retryable`` defaults to whether the error is transient.
+        """
+        if retryable is None:
+            retryable = is_transient(error)
+        attempts = self._attempts.get(update.update_id, 0) + 1
+        if retryable and attempts <= self.max_retries:
+            self._attempts.set(update.update_id, attempts)
+            delay = self.delay * 2 ** (attempts - 1)
+            UPDATE_RETRIES.inc()
+            logger.warning(f"Update {update.update_id} failed ({error!r}), retry {attempts} in {delay:g}s")
+            asyncio.get_running_loop().call_later(delay, self.application.update_queue.put_nowait, update)
+            return
+
+        self._attempts.delete(update.update_id)
+        await self.dead_letter(update, error, attempts)
+
+    async def call(self, func, *args):
+        """Await ``func(*args)``, retrying transient failures; the last error is raised"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await func(*args)
+            except Exception as e:
+                if attempt == self.max_retries or not is_transient(e):
+                    raise
+                delay = self.delay * 2 ** attempt
+                UPDATE_RETRIES.inc()
+                logger.warning(f"{func.__name__} failed ({e!r}), retry {attempt + 1} in {delay:g}s")
+                await asyncio.sleep(delay)
+
+    async def dead_letter(self, update, error, attempts, notify=True):
+        """Store ``update`` in failed_updates and, unless ``notify`` is False, tell the user"""
+        UPDATES_DEAD_LETTERED.inc()
+        logger.error(f"Update {update.update_id} failed {attempts} times, giving up: {error!r}")
+        try:
+            await self.repo.add_failed_update(
+                update.update_id, json.dumps(update.to_dict()), repr(error), attempts
+            )
+        except Exception as e:
+            logger.error(f"Could not store failed update {update.update_id}: {e}")
+        if notify and self.notify is not None:
+            try:
+                await self.notify(update)
+            except Exception as e:
+                logger.warning(f"Could not tell the user about failed update {update.update_id}: {e}")
@@ -0,0 +1,88 @@
+import os
+import asyncio
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def webhook_enabled():
+    """Whether updates arrive by webhook (Render or an explicit WEBHOOK_URL) rather than polling"""
+    return bool(os.environ.get("RENDER") or os.environ.get("WEBHOOK_URL"))
+
+
+def worker_count():
+    """How many processes serve the bot: in webhook mode WEB_CONCURRENCY, or one per core; else one"""
+    if not webhook_enabled():
+        return 1
+    return max(int(os.environ.get("WEB_CONCURRENCY") or os.cpu_count() or 1), 1)
+
+
+def webhook_url(bot_token):
+    """The URL Telegram should post updates to"""
+    url = os.environ.get("WEBHOOK_URL")
+    if not url:
+        # Construct from Render service URL
+        service_url = os.environ.get("RENDER_EXTERNAL_URL", "https://your-service.onrender.com")
+        url = f"{service_url}/webhook/{bot_token}"
+    return url
+
+
+def api_base_urls():
+    """Builder/Bot arguments pointing at TELEGRAM_API_URL (a self-hosted or fake Bot API), if set"""
+    api_url = os.environ.get("TELEGRAM_API_URL")
+    if not api_url:
+        return {}
+    api_url = api_url.rstrip("/")
+    return {"base_url": f"{api_url}/bot", "base_file_url": f"{api_url}/file/bot"}
+
+
+def webhook_secret(bot_token):
+    """Secret Telegram sends in the X-Telegram-Bot-Api-Secret-Token header.
+
+    WEBHOOK_SECRET if set, otherwise derived from the bot token so every
+    worker and the gunicorn master agree on it without extra configuration.
+    """
+    return os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{bot_token}".encode()).hexdigest()
+
+
+def webhook_max_connections():
+    """How many webhook requests Telegram may have open at once (1-100)"""
+    return min(max(int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 40)), 1), 100)
+
+
+async def setup_webhook(bot, allowed_updates=None):
+    """Point Telegram at this service for ``allowed_updates`` (None means all types).
+
+    Always calls setWebhook: getWebhookInfo does not report the secret, so
+    there is no way to tell whether the registered one is still current.
+    """
+    url = webhook_url(bot.token)
+    max_connections = webhook_max_connections()
+    logger.info(
+        f"Setting webhook URL: {url} (updates: {', '.join(allowed_updates) if allowed_updates else 'all'}, "
+        f"max_connections={max_connections})"
+    )
+    await bot.set_webhook(
+        url=url,
+        allowed_updates=allowed_updates,
+        max_connections=max_connections,
+        secret_token=webhook_secret(bot.token)
+    )
+
+
+def register_webhook(bot_token, allowed_updates=None):
+    """Register the webhook once per deployment, e.g. from ``flask --app main set-webhook``.
+
+    Errors are logged rather than raised so the server still starts.
+    """
+    from telegram import Bot
+
+    async def register():
+        async with Bot(bot_token, **api_base_urls()) as bot:
+            await setup_webhook(bot, allowed_updates)
+
+    try:
+        asyncio.run(register())
+    except Exception as e:
+        logger.error(f"Error setting up webhook: {e}")